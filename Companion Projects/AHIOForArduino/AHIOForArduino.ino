@@ -1,3 +1,11 @@
+#define DIGITAL_PINS 14
+#define ANALOG_PINS  6
+
+// streaming, see startStream()
+#define STREAM_MAX_BLOCK 32
+#define STREAM_OVERRUN   0x01
+#define STREAM_END       0x80
+
 void handshake();
 
 void setup()
@@ -44,10 +52,110 @@ byte convertAnalogReference(uint8_t reference)
     }
 }
 
+byte     StreamMask     = 0;
+byte     StreamChannels = 0;
+byte     StreamBlock    = 0;
+byte     StreamCount    = 0;
+byte     StreamSequence = 0;
+byte     StreamFlags    = 0;
+uint32_t StreamPeriod   = 0;
+uint32_t StreamNext     = 0;
+byte     StreamFrame[3 + 2 * ANALOG_PINS * STREAM_MAX_BLOCK];
+
+// Frames are 0xA5 0x5A, sequence, flags, sample count, the samples (each
+// channel's value, high byte first) and the sum of the bytes from sequence
+// to the last sample.
+void sendStreamFrame()
+{
+    uint16_t size = 3 + 2 * StreamChannels * StreamCount;
+    byte     sum  = 0;
+    StreamFrame[0] = StreamSequence++;
+    StreamFrame[1] = StreamFlags;
+    StreamFrame[2] = StreamCount;
+    for ( uint16_t i = 0; i < size; i++ ) {
+        sum += StreamFrame[i];
+    }
+    Serial.write(0xA5);
+    Serial.write(0x5A);
+    Serial.write(StreamFrame, size);
+    Serial.write(sum);
+    StreamCount = 0;
+    StreamFlags = 0;
+}
+
+void startStream(byte mask, uint32_t period, byte block)
+{
+    StreamMask     = mask & ( (1 << ANALOG_PINS) - 1 );
+    StreamChannels = 0;
+    for ( byte pin = 0; pin < ANALOG_PINS; pin++ ) {
+        if ( StreamMask & (1 << pin) ) {
+            StreamChannels++;
+        }
+    }
+    StreamBlock    = constrain(block, 1, STREAM_MAX_BLOCK);
+    StreamPeriod   = period;
+    StreamCount    = 0;
+    StreamSequence = 0;
+    StreamFlags    = 0;
+    StreamNext     = micros();
+}
+
+void stopStream()
+{
+    StreamMask  = 0;
+    StreamCount = 0;
+    StreamFlags = STREAM_END;
+    sendStreamFrame();
+}
+
+void sampleStream()
+{
+    uint32_t now = micros();
+    if ( (int32_t) (now - StreamNext) < 0 ) {
+        return;
+    }
+    if ( now - StreamNext >= StreamPeriod ) {
+        // missed at least one sample, restart the schedule from now
+        StreamFlags |= STREAM_OVERRUN;
+        StreamNext   = now;
+    }
+    StreamNext += StreamPeriod;
+
+    byte *data = StreamFrame + 3 + 2 * StreamChannels * StreamCount;
+    for ( byte pin = 0; pin < ANALOG_PINS; pin++ ) {
+        if ( StreamMask & (1 << pin) ) {
+            uint16_t val = analogRead(pin);
+            *data++ = (val >> 8) & 0xFF;
+            *data++ = val & 0xFF;
+        }
+    }
+    if ( ++StreamCount == StreamBlock ) {
+        sendStreamFrame();
+    }
+}
+
+uint32_t readLong()
+{
+    uint32_t value = 0;
+    for ( byte i = 0; i < 4; i++ ) {
+        waitForSerial();
+        value = (value << 8) | Serial.read();
+    }
+    return value;
+}
+
 void loop()
 {
+    if ( StreamMask ) {
+        sampleStream();
+    }
+
     if ( Serial.available() > 0 ) {
-        if ( Serial.read() == 0x02 ) {
+        byte b = Serial.read();
+        if ( b == 0x01 ) {
+            // handshake from a driver that connected without a reset
+            Serial.write(0x06);
+        } else if ( b == 0x02 ) {
             waitForSerial();
             byte command = Serial.read();
 
@@ -124,6 +232,70 @@ void loop()
                     break;
                 }
 
+                case 0xC9: // read all digital
+                {
+                    // bit n is pin n, pins 0-7 in the first byte
+                    uint16_t bits = 0;
+                    for ( byte pin = 0; pin < DIGITAL_PINS; pin++ ) {
+                        if ( digitalRead(pin) ) {
+                            bits |= 1 << pin;
+                        }
+                    }
+                    Serial.write(bits & 0xFF);
+                    Serial.write( (bits >> 8) & 0xFF );
+                    break;
+                }
+
+                case 0xCA: // read all analog
+                {
+                    // channel count followed by each value, high byte first
+                    byte frame[1 + 2 * ANALOG_PINS];
+                    frame[0] = ANALOG_PINS;
+                    for ( byte pin = 0; pin < ANALOG_PINS; pin++ ) {
+                        uint16_t val = analogRead(pin);
+                        frame[1 + 2 * pin] = (val >> 8) & 0xFF;
+                        frame[2 + 2 * pin] = val & 0xFF;
+                    }
+                    Serial.write(frame, sizeof(frame));
+                    break;
+                }
+
+                case 0xCB: // start streaming
+                {
+                    // channel mask, period in microseconds (high byte first)
+                    // and samples per frame
+                    waitForSerial();
+                    byte     mask   = Serial.read();
+                    uint32_t period = readLong();
+                    waitForSerial();
+                    byte block = Serial.read();
+                    startStream(mask, period, block);
+                    break;
+                }
+
+                case 0xCC: // stop streaming
+                    stopStream();
+                    break;
+
+                case 0xCD: // set mode of all digital pins
+                {
+                    // bit n set makes pin n an input, pins 0-7 in the first
+                    // byte. Outputs start low.
+                    waitForSerial();
+                    uint16_t mask = Serial.read();
+                    waitForSerial();
+                    mask |= Serial.read() << 8;
+                    for ( byte pin = 0; pin < DIGITAL_PINS; pin++ ) {
+                        if ( mask & (1 << pin) ) {
+                            pinMode(pin, INPUT);
+                        } else {
+                            pinMode(pin, OUTPUT);
+                            digitalWrite(pin, LOW);
+                        }
+                    }
+                    break;
+                }
+
                 default:
                     break;
             }
@@ -286,7 +286,14 @@ class AbstractDriver(object):
         the pin is analog. If value is not valid for the given
         pwm/analog|digital combination, raise TypeError.
 
+        If `pin` is a list, `value` is written to all of them, unless `value`
+        is also a list, in which case each pin is set to the value in the same
+        position. Lists can be nested, with values nested the same way.
+
         If you're developing a driver, implement _write(self, pin, value, pwm)
+        and, if the hardware can set many pins at once,
+        _write_many(self, pins, values, pwm), which receives lists of your
+        internal IDs and values.
 
         @arg pin the pin to write to
         @arg value the value to write on the pin
@@ -298,31 +305,51 @@ class AbstractDriver(object):
         @throw KeyError if pin isn't mapped.
         """
         if type(pin) is list:
-            for p in pin:
-                self.write(p, value, pwm)
+            values = value if type(value) is list else [value] * len(pin)
+            if len(values) != len(pin):
+                raise TypeError("pin and value lists have different lengths")
+            if any(type(p) is list for p in pin):
+                # nested lists are written one level at a time
+                for p, v in zip(pin, values):
+                    self.write(p, v, pwm)
+                return
+            pin_ids = [self._mapped_pin_id(p) for p in pin]
+            for p, v in zip(pin, values):
+                self._check_write_value(v, pwm)
+            values = [self._interpolate_write(p, v) for p, v in zip(pin, values)]
+            self._write_many(pin_ids, values, pwm)
             return
 
+        self._check_write_value(value, pwm)
+        pin_id = self._mapped_pin_id(pin)
+        self._write(pin_id, self._interpolate_write(pin, value), pwm)
+
+    def _write_many(self, pins, values, pwm):
+        for pin, value in zip(pins, values):
+            self._write(pin, value, pwm)
+
+    def _check_write_value(self, value, pwm):
         if pwm and type(value) is not int and type(value) is not float:
             raise TypeError("pwm is set, but value is not a float or int")
 
-        pin_id = self._pin_mapping.get(pin, None)
-        if pin_id:
-            lpin = self._pin_lin.get(pin, None)
-            if lpin and type(lpin["write"]) is tuple:
-                write_range = lpin["write"]
-                value = self._linear_interpolation(value, *write_range)
-            self._write(pin_id, value, pwm)
-        else:
-            raise KeyError("Requested pin is not mapped: %s" % pin)
+    def _interpolate_write(self, pin, value):
+        lpin = self._pin_lin.get(pin, None)
+        if lpin and type(lpin["write"]) is tuple:
+            write_range = lpin["write"]
+            value = self._linear_interpolation(value, *write_range)
+        return value
 
     def read(self, pin):
         """Reads value from pin `pin`.
 
         Returns the value read from pin `pin`. If it's an analog pin, returns
         a number in analog.input_range. If it's digital, returns
-        `ahio.LogicValue`.
+        `ahio.LogicValue`. If `pin` is a list, returns a list with the value
+        of each pin, nested like `pin` if it holds lists.
 
-        If you're developing a driver, implement _read(self, pin)
+        If you're developing a driver, implement _read(self, pin) and, if the
+        hardware can read many pins at once, _read_many(self, pins), which
+        receives a list of your internal IDs and returns a list of values.
 
         @arg pin the pin to read from
         @returns the value read from the pin
@@ -330,18 +357,31 @@ class AbstractDriver(object):
         @throw KeyError if pin isn't mapped.
         """
         if type(pin) is list:
-            return [self.read(p) for p in pin]
-
+            if any(type(p) is list for p in pin):
+                # nested lists are read one level at a time
+                return [self.read(p) for p in pin]
+            pin_ids = [self._mapped_pin_id(p) for p in pin]
+            values = self._read_many(pin_ids)
+            return [self._interpolate_read(p, v) for p, v in zip(pin, values)]
+
+        pin_id = self._mapped_pin_id(pin)
+        return self._interpolate_read(pin, self._read(pin_id))
+
+    def _read_many(self, pins):
+        return [self._read(pin) for pin in pins]
+
+    def _interpolate_read(self, pin, value):
+        lpin = self._pin_lin.get(pin, None)
+        if lpin and type(lpin["read"]) is tuple:
+            read_range = lpin["read"]
+            value = self._linear_interpolation(value, *read_range)
+        return value
+
+    def _mapped_pin_id(self, pin):
         pin_id = self._pin_mapping.get(pin, None)
-        if pin_id:
-            value = self._read(pin_id)
-            lpin = self._pin_lin.get(pin, None)
-            if lpin and type(lpin["read"]) is tuple:
-                read_range = lpin["read"]
-                value = self._linear_interpolation(value, *read_range)
-            return value
-        else:
+        if not pin_id:
             raise KeyError("Requested pin is not mapped: %s" % pin)
+        return pin_id
 
     def analog_references(self):
         """Possible values for analog reference.
@@ -0,0 +1,61 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""@package ahio.clock
+Sources of time for simulated devices.
+
+Simulated devices, like the SISO Model driver, evolve according to a clock
+instead of the number of times they're read. `WallClock` follows real time,
+while `VirtualClock` only moves when told to, so a control loop can be tested
+faster than real time and with repeatable timing.
+"""
+
+import threading
+import time
+
+
+class WallClock(object):
+    """Real time, in seconds, from `time.monotonic()`."""
+
+    def now(self):
+        return time.monotonic()
+
+
+class VirtualClock(object):
+    """Time that only moves with `advance`."""
+
+    def __init__(self, start=0.0):
+        """@arg start initial time, in seconds."""
+        self._now = float(start)
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self._now
+
+    def advance(self, seconds):
+        """Moves the time `seconds` forward.
+
+        @throw ValueError if `seconds` is negative.
+        """
+        if seconds < 0:
+            raise ValueError("Time can not go backwards")
+        with self._lock:
+            self._now += seconds
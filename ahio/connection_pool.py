@@ -0,0 +1,147 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""@package ahio.connection_pool
+Shares client connections between driver instances.
+
+Opening the same serial port twice fails, and opening many connections to the
+same gateway multiplies its load. Drivers can instead acquire their client
+from `pool`, which keeps one client per configuration, serializes the
+requests made through it with a `ahio.scheduler.PriorityScheduler` and closes
+it when the last user releases it.
+"""
+
+import ast
+import threading
+
+from ahio.scheduler import Priority, PriorityScheduler
+
+
+def configuration_key(configuration):
+    """Returns a key that identifies a client configuration string.
+
+    Configurations that only differ in formatting, like whitespace or quotes,
+    produce the same key.
+    """
+    try:
+        return ast.dump(ast.parse(configuration.strip(), mode="eval"))
+    except SyntaxError:
+        return configuration
+
+
+class SharedConnection(object):
+    """A client shared by many users.
+
+    Requests to the client go through `request`, which waits for the
+    scheduler to grant the client, so requests from different threads never
+    interleave on the wire. Calling a method of the client directly through
+    this object does the same with the `Write` priority for methods named
+    write* and `Read` for the others. Other attributes are returned as-is.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.scheduler = PriorityScheduler()
+        self.users = 0
+        # held while the client is being created
+        self.connecting = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+        priority = Priority.Write if name.startswith("write") else Priority.Read
+
+        def request(*args, **kwargs):
+            return self.scheduler.request(priority, attr, *args, **kwargs)
+
+        return request
+
+    def request(self, priority, name, *args, **kwargs):
+        """Calls the client's method `name` with the given `priority`.
+
+        @arg priority a value from `ahio.scheduler.Priority`.
+        @arg name name of the client's method.
+        """
+        method = getattr(self.client, name)
+        return self.scheduler.request(priority, method, *args, **kwargs)
+
+
+class ConnectionPool(object):
+    """Keeps one `SharedConnection` per key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def acquire(self, key, factory):
+        """Returns the connection for `key`, creating it if needed.
+
+        @arg key identifies the connection, see `configuration_key`.
+        @arg factory function called without arguments to create a connected
+             client when there's none for `key`. The client must have a
+             `close()` method. It should raise if it can't connect, nothing
+             is kept in the pool then.
+
+        Only users of the same key wait for `factory`, so a slow connection
+        doesn't hold back the other connections of the pool.
+
+        @returns a `SharedConnection`
+        """
+        with self._lock:
+            connection = self._connections.get(key, None)
+            if connection is None:
+                connection = SharedConnection(None)
+                self._connections[key] = connection
+            connection.users += 1
+        with connection.connecting:
+            if connection.client is None:
+                try:
+                    connection.client = factory()
+                except BaseException:
+                    self._discard(key, connection)
+                    raise
+        return connection
+
+    def _discard(self, key, connection):
+        with self._lock:
+            connection.users -= 1
+            if connection.users == 0 and self._connections.get(key) is connection:
+                del self._connections[key]
+
+    def release(self, key):
+        """Releases one use of `key`, closing the client on the last one."""
+        with self._lock:
+            connection = self._connections.get(key, None)
+            if connection is None:
+                return
+            connection.users -= 1
+            if connection.users > 0:
+                return
+            del self._connections[key]
+        if connection.client is None:
+            return
+        connection.scheduler.request(Priority.Write, connection.client.close)
+
+
+# process wide pool
+pool = ConnectionPool()
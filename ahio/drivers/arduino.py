@@ -21,11 +21,27 @@
 # THE SOFTWARE.
 
 import ahio.abstract_driver
+from ahio.serial_transport import SerialTransport
 
 import serial
+import threading
 import time
 from enum import Enum
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# streaming frames start with these bytes, see start_stream
+STREAM_SYNC = b"\xA5\x5A"
+STREAM_OVERRUN = 0x01
+STREAM_END = 0x80
+# most samples the firmware puts in a frame
+STREAM_MAX_BLOCK = 32
+# seconds between handshake attempts while the board boots
+HANDSHAKE_INTERVAL = 0.05
+
 
 class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
     NAME = "Arduino"
@@ -41,33 +57,109 @@ class Driver(ahio.abstract_driver.AbstractDriver):
 
     AnalogReferences = Enum("AnalogReferences", "Default Internal External")
 
+    def __init__(self):
+        # pin directions as last set by this driver, see sync_pin_directions
+        self._directions = {}
+        # the running stream and the last one started, which may have stopped
+        self._stream = None
+        self._samples = None
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        pass
+        if self._stream:
+            self.stop_stream()
 
-    def setup(self, port):
+    def setup(self, port, reset=True, timeout=5):
         """Connects to an Arduino UNO on serial port `port`.
 
+        Opening the port resets most boards, which then take a moment to
+        boot. The driver keeps sending the handshake until the board answers,
+        so it connects as soon as the board is ready.
+
+        All digital pins are set as outputs. The driver keeps track of the
+        directions it sets, so writes don't have to ask the board for them,
+        see `sync_pin_directions`.
+
+        @arg port serial port the Arduino is connected to.
+        @arg reset False to keep DTR low while opening the port, which keeps
+             boards that reset on DTR from resetting, making the connection
+             faster. Some systems raise DTR on open anyway.
+        @arg timeout seconds to wait for the board to answer.
+
         @throw RuntimeError can't connect to Arduino
         """
         port = str(port)
         # timeout is used by all I/O operations
-        self._serial = serial.Serial(port, 115200, timeout=2)
-        time.sleep(2)  # time to Arduino reset
+        connection = serial.Serial(None, 115200, timeout=2)
+        connection.port = port
+        if not reset:
+            connection.dtr = False
+        connection.open()
+        self._serial = SerialTransport(connection)
 
         if not self._serial.is_open:
             raise RuntimeError("Could not connect to Arduino")
 
-        self._serial.write(b"\x01")
+        if not reset:
+            # a board that wasn't reset may still be streaming
+            self._serial.write(b"\x02\xCC")
+        self._handshake(timeout)
 
-        if self._serial.read() != b"\x06":
-            raise RuntimeError("Could not connect to Arduino")
+        directions = {}
+        for pin in self.available_pins():
+            if pin["digital"]["output"]:
+                directions[pin["id"]] = ahio.Direction.Output
+            else:
+                self._directions[pin["id"]] = ahio.Direction.Input
+        self._set_pin_directions(directions)
+
+    def _handshake(self, timeout):
+        deadline = time.monotonic() + timeout
+        self._serial.timeout = HANDSHAKE_INTERVAL
+        try:
+            while time.monotonic() < deadline:
+                self._serial.reset_input_buffer()
+                self._serial.write(b"\x01")
+                if self._serial.read() == b"\x06":
+                    # drop late answers to earlier attempts
+                    while self._serial.read():
+                        pass
+                    return
+        finally:
+            self._serial.timeout = 2
+        raise RuntimeError("Could not connect to Arduino")
+
+    def _set_pin_directions(self, directions):
+        # sets the direction of digital pins in a single frame, pins that are
+        # not in directions are set as outputs
+        mask = 0
+        for pin, direction in directions.items():
+            if direction == ahio.Direction.Input:
+                mask |= 1 << (pin.value - 1)
+        self._serial.write(b"\x02\xCD" + mask.to_bytes(2, "little"))
+        for pin in Driver.Pins:
+            if pin.name.startswith("D"):
+                self._directions[pin] = directions.get(pin, ahio.Direction.Output)
 
-        ps = [p for p in self.available_pins() if p["digital"]["output"]]
-        for pin in ps:
-            self._set_pin_direction(pin["id"], ahio.Direction.Output)
+    def sync_pin_directions(self):
+        """Reads the direction of every pin from the Arduino.
+
+        The driver remembers the direction it sets for each pin instead of
+        asking the board before every write. Call this if something else, like
+        a reset of the board, may have changed them.
+        """
+        self._directions = {}
+        pins = list(Driver.Pins)
+        with self._serial.batch():
+            for pin in pins:
+                self._serial.write(b"\x02\xC4" + bytes({pin.value - 1}))
+        answers = self._read_exactly(len(pins))
+        directions = {0: ahio.Direction.Output, 1: ahio.Direction.Input}
+        for pin, answer in zip(pins, answers):
+            if answer in directions:
+                self._directions[pin] = directions[answer]
 
     def __clamp(self, value, min, max):
         return sorted((min, value, max))[1]
@@ -114,20 +206,26 @@ class Driver(ahio.abstract_driver.AbstractDriver):
             self._serial.write(b"\x02\xC3" + bytes({pin.value - 1}) +
                                bytes({1}))
         else:
-            self._serial.write(b"\x02\xC3" + bytes({pin.value - 1}) +
-                               bytes({0}))
-            self._serial.write(b"\x02\xC7" + bytes({pin.value - 1}) +
-                               bytes({0}))
+            with self._serial.batch():
+                self._serial.write(b"\x02\xC3" + bytes({pin.value - 1}) +
+                                   bytes({0}))
+                self._serial.write(b"\x02\xC7" + bytes({pin.value - 1}) +
+                                   bytes({0}))
+        self._directions[pin] = direction
 
     def _pin_direction(self, pin):
+        if pin in self._directions:
+            return self._directions[pin]
         self._serial.write(b"\x02\xC4" + bytes({pin.value - 1}))
         direction = self._serial.read()
         if direction == b"\x01":
-            return ahio.Direction.Input
+            direction = ahio.Direction.Input
         elif direction == b"\x00":
-            return ahio.Direction.Output
+            direction = ahio.Direction.Output
         else:
             return None
+        self._directions[pin] = direction
+        return direction
 
     def _set_pin_type(self, pin, ptype):
         is_analog = pin.name.startswith("A")
@@ -169,17 +267,161 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         else:
             raise RuntimeError("Can not write to analog pin")
 
+    def _write_many(self, pins, values, pwm):
+        with self._serial.batch():
+            for pin, value in zip(pins, values):
+                self._write(pin, value, pwm)
+
+    def start_stream(self, pins, rate, block=16, capacity=65536):
+        """Starts sampling analog pins continuously on the Arduino.
+
+        The Arduino samples `pins` every 1/`rate` seconds and sends them in
+        numbered frames of `block` samples. A background thread decodes the
+        frames into a ring buffer of `capacity` samples, from where they're
+        taken by `read_block` or `iter_blocks`. Samples are the raw values of
+        the analog to digital converter, from 0 to 1023, without
+        interpolation.
+
+        While streaming, pins can be written but not read. The serial link
+        limits the rate: each sample takes 2 bytes per pin.
+
+        @arg pins list of pin ids you've set using `map_pin`, all analog.
+        @arg rate samples per second.
+        @arg block samples per frame, up to 32. Bigger frames have less
+             overhead and smaller ones less latency.
+        @arg capacity samples kept in the ring buffer.
+
+        @throw RuntimeError if already streaming, if a pin isn't analog or if
+               numpy is not installed.
+        @throw KeyError if a pin isn't mapped.
+        """
+        if np is None:
+            raise RuntimeError("Streaming needs numpy")
+        if self._stream:
+            raise RuntimeError("Already streaming")
+        channels = [self._mapped_pin_id(pin) for pin in pins]
+        if not all(pin.name.startswith("A") for pin in channels):
+            raise RuntimeError("Only analog pins can be streamed")
+        mask = 0
+        for pin in channels:
+            mask |= 1 << (pin.value - 15)
+        # the firmware sends the channels in ascending order
+        order = sorted(set(pin.value for pin in channels))
+        columns = [order.index(pin.value) for pin in channels]
+        block = min(max(int(block), 1), STREAM_MAX_BLOCK)
+        capacity = max(int(capacity), block)
+        period = int(round(1e6 / rate))
+        self._stream = _Stream(self._serial, len(order), columns, capacity)
+        self._samples = self._stream
+        self._serial.write(
+            b"\x02\xCB" + bytes([mask]) + period.to_bytes(4, "big") + bytes([block])
+        )
+        self._stream.start()
+
+    def stop_stream(self):
+        """Stops sampling, see `start_stream`.
+
+        Samples already received can still be taken with `read_block`.
+        """
+        stream = self._stream
+        if not stream:
+            return
+        stream.stop()
+        self._serial.write(b"\x02\xCC")
+        stream.join()
+        self._stream = None
+
+    def read_block(self, n, timeout=None):
+        """Takes the next `n` samples from the stream.
+
+        Blocks until `n` samples are available. If the ring buffer filled up
+        before samples were taken, the oldest ones were lost and are counted
+        in `stream_metrics`.
+
+        @arg n amount of samples.
+        @arg timeout seconds to wait, None waits until the stream stops.
+
+        @returns a numpy array of shape (`n`, number of pins) with the pins in
+        the order given to `start_stream`. Fewer samples are returned if the
+        timeout expires or the stream stops.
+
+        @throw RuntimeError if not streaming.
+        """
+        if self._samples is None:
+            raise RuntimeError("Not streaming")
+        return self._samples.take(n, timeout)
+
+    def iter_blocks(self, n):
+        """Yields blocks of `n` samples until the stream stops.
+
+        See `read_block`.
+        """
+        while True:
+            samples = self.read_block(n)
+            if len(samples):
+                yield samples
+            if len(samples) < n:
+                return
+
+    def stream_metrics(self):
+        """Returns counters of the stream.
+
+        @returns a dictionary with the amount of frames and samples received,
+        frames lost or corrupted on the link (`dropped_frames`), frames that
+        failed the checksum (`checksum_errors`), frames in which the Arduino
+        could not keep the rate (`overruns`) and samples lost because the
+        ring buffer was full (`buffer_overruns`).
+        """
+        return self._samples.metrics() if self._samples else {}
+
     def _read(self, pin):
+        if self._stream:
+            raise RuntimeError("Can not read pins while streaming")
         if pin.name.startswith("D"):
             self._serial.write(b"\x02\xC5" + bytes({pin.value - 1}))
             value = self._serial.read()
             lv = ahio.LogicValue
             return lv.High if value == b"\x01" else lv.Low
         else:
-            self._serial.write(b"\x02\xC6" + bytes({pin.value - 14}))
-            value_high = self._serial.read()
-            value_low = self._serial.read()
-            return (value_high[0] << 8) | value_low[0]
+            self._serial.write(b"\x02\xC6" + bytes({pin.value - 15}))
+            value = self._read_exactly(2)
+            return (value[0] << 8) | value[1]
+
+    def _read_many(self, pins):
+        # the values of all digital pins come in a single bitmask and of all
+        # analog pins in a single frame, fetched in one exchange
+        if len(pins) < 2 or self._stream:
+            return [self._read(pin) for pin in pins]
+        digital = any(pin.name.startswith("D") for pin in pins)
+        analog = any(pin.name.startswith("A") for pin in pins)
+        command = b""
+        if digital:
+            command += b"\x02\xC9"
+        if analog:
+            command += b"\x02\xCA"
+        self._serial.write(command)
+        if digital:
+            bits = self._read_exactly(2)
+            bits = bits[0] | (bits[1] << 8)
+        if analog:
+            count = self._read_exactly(1)[0]
+            frame = self._read_exactly(2 * count)
+        lv = ahio.LogicValue
+        values = []
+        for pin in pins:
+            if pin.name.startswith("D"):
+                n = pin.value - 1
+                values.append(lv.High if (bits >> n) & 1 else lv.Low)
+            else:
+                n = pin.value - 15
+                values.append((frame[2 * n] << 8) | frame[2 * n + 1])
+        return values
+
+    def _read_exactly(self, size):
+        try:
+            return self._serial.read_exactly(size)
+        except RuntimeError:
+            raise RuntimeError("Arduino did not answer")
 
     def analog_references(self):
         return [r for r in Driver.AnalogReferences]
@@ -201,3 +443,124 @@ class Driver(ahio.abstract_driver.AbstractDriver):
     def _set_pwm_frequency(self, frequency, pin):
         raise RuntimeError(
             "Setting PWM frequency is not supported by hardware")
+
+
+class _Stream(threading.Thread):
+    """Decodes stream frames into a ring buffer."""
+
+    def __init__(self, port, channels, columns, capacity):
+        super().__init__(daemon=True)
+        self._port = port
+        self._channels = channels
+        self._columns = columns
+        self._buffer = np.zeros((capacity, channels), dtype=np.uint16)
+        self._condition = threading.Condition()
+        self._written = 0
+        self._taken = 0
+        self._done = False
+        self._stopping = False
+        self._sequence = None
+        self._metrics = dict.fromkeys(
+            (
+                "frames",
+                "samples",
+                "dropped_frames",
+                "checksum_errors",
+                "overruns",
+                "buffer_overruns",
+            ),
+            0,
+        )
+
+    def run(self):
+        try:
+            while self._frame():
+                pass
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def _frame(self):
+        # returns False when the stream ends
+        if not self._sync():
+            return False
+        header = self._read(3)
+        if header is None:
+            return False
+        sequence, flags, count = header
+        size = 2 * self._channels * count
+        data = self._read(size + 1)
+        if data is None:
+            return False
+        metrics = self._metrics
+        if (sum(header) + sum(data[:-1])) & 0xFF != data[-1]:
+            metrics["checksum_errors"] += 1
+            return True
+        if self._sequence is not None:
+            metrics["dropped_frames"] += (sequence - self._sequence - 1) & 0xFF
+        self._sequence = sequence
+        if flags & STREAM_END:
+            return False
+        if flags & STREAM_OVERRUN:
+            metrics["overruns"] += 1
+        samples = np.frombuffer(data[:-1], dtype=">u2").reshape(count, self._channels)
+        self._store(samples)
+        metrics["frames"] += 1
+        metrics["samples"] += count
+        return True
+
+    def _sync(self):
+        # skips bytes up to the start of a frame
+        last = b""
+        while True:
+            byte = self._read(1)
+            if byte is None:
+                return False
+            if last + byte == STREAM_SYNC:
+                return True
+            last = byte
+
+    def _read(self, size):
+        # reads `size` bytes, waiting through the port timeouts, as frames can
+        # take longer than that at low rates. Once stopping, silence means
+        # the Arduino won't send the end frame and None is returned
+        data = b""
+        while len(data) < size:
+            chunk = self._port.read(size - len(data))
+            if not chunk and self._stopping:
+                return None
+            data += chunk
+        return data
+
+    def stop(self):
+        self._stopping = True
+
+    def _store(self, samples):
+        rows = np.arange(self._written, self._written + len(samples))
+        with self._condition:
+            self._buffer[rows % len(self._buffer)] = samples
+            self._written += len(samples)
+            self._condition.notify_all()
+
+    def take(self, n, timeout):
+        capacity = len(self._buffer)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._written - self._taken < n and not self._done:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    break
+                self._condition.wait(wait)
+            lost = self._written - self._taken - capacity
+            if lost > 0:
+                self._metrics["buffer_overruns"] += lost
+                self._taken += lost
+            n = min(n, self._written - self._taken)
+            rows = np.arange(self._taken, self._taken + n) % capacity
+            self._taken += n
+            return self._buffer[rows][:, self._columns]
+
+    def metrics(self):
+        with self._condition:
+            return dict(self._metrics)
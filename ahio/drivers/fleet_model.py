@@ -0,0 +1,259 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+
+import ahio.abstract_driver
+import ahio.clock
+import ahio.state_space
+import numpy as np
+
+
+class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
+    NAME = "Fleet Model"
+    AVAILABLE = True
+
+
+_CHANNEL = re.compile(r"^(?P<kind>[UY])(?P<plant>\d+)(?:\.(?P<index>\d+))?$")
+
+
+class Driver(ahio.abstract_driver.AbstractDriver):
+    x = None
+    u = None
+    # outputs, computed when read
+    y = None
+    model = None
+    dt = None
+    clock = None
+    # clock time the state x refers to
+    t = None
+
+    def __init__(self):
+        self._channels = {}
+        self._sizes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def setup(
+        self, models="[([[0.5]], [[1]], [[1]], [[0]], 1)] * 2", clock=None, dt=None
+    ):
+        """Simulates many linear models at once.
+
+        Each model is described like in the SISO Model driver: a tuple of
+        arrays accepted by `scipy.signal.lti` or, with the sample time as last
+        element, `scipy.signal.dlti`. `models` is a list of such tuples, of
+        strings with them or of paths of files with them (see
+        `ahio.state_space.load`), or a string with that list.
+
+        All models advance together, one sample for each sample time elapsed
+        on `clock`. Models of different orders are padded with zeros to the
+        largest one and stacked, so a step of the whole fleet is a single
+        batched product, whatever the number of models.
+
+        The pins are strings: "U17" and "Y17" are the first input and output
+        of the model at index 17 of the list (counting from 0), "U17.2" and
+        "Y17.2" their second input and output.
+
+        @arg models the models, by default two discrete first order systems.
+        @arg clock an `ahio.clock.WallClock` (the default) or
+             `ahio.clock.VirtualClock`, advanced by the caller.
+        @arg dt sample time of the continuous models. By default it's the
+             sample time of the discrete models, or the smallest one chosen
+             for the continuous models if there are none.
+
+        @throw ValueError if the discrete models have different sample times,
+               or a sample time other than `dt`.
+        """
+        if type(models) is str:
+            models = eval(models)
+        models = [ahio.state_space.parse(m) for m in models]
+        if not models:
+            raise ValueError("The fleet must have at least one model")
+        discrete = [float(m[-1]) for m in models if len(m) % 2 == 1]
+        if discrete:
+            if dt is None:
+                dt = discrete[0]
+            if any(d != dt for d in discrete):
+                raise ValueError("Discrete models must have the same sample time")
+        matrices = [ahio.state_space.discretize(m, dt) for m in models]
+        if dt is None:
+            dt = min(M[-1] for M in matrices)
+            matrices = [ahio.state_space.discretize(m, dt) for m in models]
+
+        self._sizes = [(M[1].shape[1], M[2].shape[0]) for M in matrices]
+        k = len(matrices)
+        n = max(M[0].shape[0] for M in matrices)
+        m = max(s[0] for s in self._sizes)
+        p = max(s[1] for s in self._sizes)
+        # the padded states have no dynamics and no effect on the outputs
+        A = np.zeros((k, n, n))
+        B = np.zeros((k, n, m))
+        C = np.zeros((k, p, n))
+        D = np.zeros((k, p, m))
+        for i, (Ai, Bi, Ci, Di, _) in enumerate(matrices):
+            ni, mi = Bi.shape
+            pi = Ci.shape[0]
+            A[i, :ni, :ni] = Ai
+            B[i, :ni, :mi] = Bi
+            C[i, :pi, :ni] = Ci
+            D[i, :pi, :mi] = Di
+        self.model = A, B, C, D
+        # state, input and output, updated in place
+        self.x = np.zeros((k, n, 1))
+        self.u = np.zeros((k, m, 1))
+        self.y = np.zeros((k, p, 1))
+        self._ax = np.zeros((k, n, 1))
+        self._bu = np.zeros((k, n, 1))
+        self._du = np.zeros((k, p, 1))
+        self._channels = {}
+        self._stale = False
+        self.dt = dt
+        self.clock = clock or ahio.clock.WallClock()
+        self.t = self.clock.now()
+
+    def map_pin(self, abstract_pin_id, physical_pin_id):
+        """Maps a pin to a model channel, see `AbstractDriver.map_pin`.
+
+        @throw ValueError if `physical_pin_id` is not a channel of the fleet.
+        """
+        if physical_pin_id:
+            self._channel(physical_pin_id)
+        super().map_pin(abstract_pin_id, physical_pin_id)
+
+    def _channel(self, pin):
+        # (is input, model, index) of a pin
+        channel = self._channels.get(pin, None)
+        if channel is not None:
+            return channel
+        match = _CHANNEL.match(str(pin).upper())
+        if not match:
+            raise ValueError("Invalid fleet pin: %s" % pin)
+        is_input = match.group("kind") == "U"
+        plant = int(match.group("plant"))
+        index = int(match.group("index") or 1) - 1
+        sizes = self._sizes[plant] if plant < len(self._sizes) else (0, 0)
+        if not 0 <= index < sizes[not is_input]:
+            raise ValueError("No such channel in the fleet: %s" % pin)
+        channel = self._channels[pin] = (is_input, plant, index)
+        return channel
+
+    def __create_pin_info(self, pid, is_input):
+        obj = {
+            "id": pid,
+            "name": pid,
+            "analog": {
+                "input": not is_input,
+                "output": is_input,
+                "read_range": (0, 100),
+                "write_range": (0, 100),
+            },
+            "digital": {"input": False, "output": False, "pwm": False},
+        }
+        return obj
+
+    def available_pins(self):
+        pins = []
+        for plant, (m, p) in enumerate(self._sizes):
+            for kind, count in (("U", m), ("Y", p)):
+                for i in range(count):
+                    name = "%s%d" % (kind, plant)
+                    if i > 0:
+                        name += ".%d" % (i + 1)
+                    pins.append(self.__create_pin_info(name, kind == "U"))
+        return pins
+
+    def _set_pin_direction(self, pin, direction):
+        pass
+
+    def _pin_direction(self, pin):
+        if self._channel(pin)[0]:
+            return ahio.Direction.Output
+        return ahio.Direction.Input
+
+    def _set_pin_type(self, pin, ptype):
+        pass
+
+    def _pin_type(self, pin):
+        return ahio.PortType.Analog
+
+    def _write(self, pin, value, pwm):
+        self._write_many([pin], [value], pwm)
+
+    def _write_many(self, pins, values, pwm):
+        is_input, plants, indexes = self._indexes(pins)
+        if not is_input.all():
+            raise RuntimeError("Can not write to an output of the model")
+        # the previous input applies until now
+        self._advance()
+        self.u[plants, indexes, 0] = values
+        self._stale = True
+
+    def _read(self, pin):
+        return self._read_many([pin])[0]
+
+    def _read_many(self, pins):
+        self._advance()
+        self._output()
+        is_input, plants, indexes = self._indexes(pins)
+        values = np.empty(len(pins))
+        values[is_input] = self.u[plants[is_input], indexes[is_input], 0]
+        is_output = ~is_input
+        values[is_output] = self.y[plants[is_output], indexes[is_output], 0]
+        return values.tolist()
+
+    def _indexes(self, pins):
+        channels = [self._channel(pin) for pin in pins]
+        is_input, plants, indexes = (np.array(c) for c in zip(*channels))
+        return is_input, plants, indexes
+
+    def _advance(self):
+        steps = ahio.state_space.samples(self.clock.now() - self.t, self.dt)
+        if steps <= 0:
+            return
+        A, B, C, D = self.model
+        ahio.state_space.advance(A, B, self.x, self.u, steps, self._ax, self._bu)
+        self.t += steps * self.dt
+        self._stale = True
+
+    def _output(self):
+        # outputs are only computed when read, so writing the pins one by
+        # one doesn't recompute the whole fleet each time
+        if self._stale:
+            A, B, C, D = self.model
+            ahio.state_space.output(C, D, self.x, self.u, self.y, self._du)
+            self._stale = False
+
+    def analog_references(self):
+        return []
+
+    def _set_analog_reference(self, reference, pin):
+        pass
+
+    def _analog_reference(self, pin):
+        return []
+
+    def _set_pwm_frequency(self, frequency, pin):
+        pass
@@ -20,7 +20,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import functools
+import inspect
+
 import ahio.abstract_driver
+import ahio.connection_pool
+from ahio.scheduler import Priority
+from ahio.serial_transport import SerialTransport, character_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
@@ -28,23 +39,223 @@ class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
     AVAILABLE = True
 
 
+# client method names used to read and write each area
+_READERS = {
+    "C": "read_coils",
+    "I": "read_discrete_inputs",
+    "R": "read_input_registers",
+    "H": "read_holding_registers",
+}
+_WRITERS = {
+    "C": "write_coil",
+    "I": None,
+    "R": "write_register",
+    "H": "write_register",
+}
+
+# big-endian numpy types for the typed register addresses
+TYPES = {
+    "int16": ">i2",
+    "uint16": ">u2",
+    "int32": ">i4",
+    "uint32": ">u4",
+    "int64": ">i8",
+    "uint64": ">u8",
+    "float32": ">f4",
+    "float64": ">f8",
+}
+
+# ABCD is big-endian, CDAB swaps words, BADC swaps bytes and DCBA swaps both
+ORDERS = ("ABCD", "CDAB", "BADC", "DCBA")
+
+# maximum amount of registers and bits a single request can carry
+MAX_REGISTERS = 125
+MAX_BITS = 2000
+
+
+def decode_registers(registers, dtype="uint16", order="ABCD"):
+    """Converts a block of registers into an array of typed values.
+
+    The whole block is converted at once, without a Python loop. Trailing
+    registers that don't form a complete value are ignored.
+
+    @arg registers a sequence of 16 bits register values.
+    @arg dtype one of the keys of `TYPES`.
+    @arg order one of `ORDERS`, how bytes of a value are laid in the registers.
+
+    @returns a numpy array with the decoded values.
+    """
+    dtype = np.dtype(TYPES[dtype])
+    words = dtype.itemsize // 2
+    raw = np.asarray(registers, dtype=np.uint16)
+    raw = raw[: raw.size - raw.size % words].reshape(-1, words)
+    if order in ("CDAB", "DCBA"):
+        raw = raw[:, ::-1]
+    wire = ">u2" if order in ("ABCD", "CDAB") else "<u2"
+    return np.frombuffer(raw.astype(wire).tobytes(), dtype=dtype)
+
+
+def encode_registers(values, dtype="uint16", order="ABCD"):
+    """Converts typed values into registers, the inverse of `decode_registers`.
+
+    @returns a list of 16 bits register values.
+    """
+    raw = np.asarray(values, dtype=TYPES[dtype]).reshape(-1)
+    words = raw.dtype.itemsize // 2
+    wire = ">u2" if order in ("ABCD", "CDAB") else "<u2"
+    raw = np.frombuffer(raw.tobytes(), dtype=wire).reshape(-1, words)
+    if order in ("CDAB", "DCBA"):
+        raw = raw[:, ::-1]
+    return raw.astype(np.uint16).reshape(-1).tolist()
+
+
+def unit_keyword(client):
+    """Returns the name of the keyword argument selecting the device.
+
+    It has been called unit, slave and device_id in different pymodbus
+    versions.
+    """
+    parameters = inspect.signature(client.read_coils).parameters
+    for name in ("device_id", "slave", "unit"):
+        if name in parameters:
+            return name
+    return "unit"
+
+
+def _check(ret):
+    if ret is None or (hasattr(ret, "isError") and ret.isError()):
+        raise RuntimeError("Modbus request failed: %s" % ret)
+    return ret
+
+
+def _decode_bits(ret):
+    bits = getattr(ret, "bits", None)
+    return int(bits[0]) if bits else 0
+
+
+def _decode_registers(ret):
+    registers = getattr(ret, "registers", None)
+    return float(registers[0]) if registers else 0
+
+
+def _encode_bit(value):
+    return {ahio.LogicValue.High: 1, ahio.LogicValue.Low: 0}.get(value, value)
+
+
+def _encode_register(value):
+    return int(value)
+
+
+class Address(object):
+    """A Modbus address compiled from its string form.
+
+    Parsing happens once, when the pin is mapped, so reads and writes only
+    need to call the bound client method. See `Driver.setup` for the format.
+    """
+
+    __slots__ = (
+        "area",
+        "unit",
+        "address",
+        "dtype",
+        "order",
+        "words",
+        "priority",
+        "read",
+        "write",
+        "decode",
+        "encode",
+    )
+
+    def __init__(self, name):
+        try:
+            area = name[0].upper()
+            unit, address, *typed = name[1:].split(":")
+            unit = int(unit)
+            address = int(address)
+        except (AttributeError, TypeError, ValueError, IndexError):
+            raise ValueError("Invalid Modbus address: %s" % name)
+        if area not in _READERS or unit < 0 or address < 0 or len(typed) > 2:
+            raise ValueError("Invalid Modbus address: %s" % name)
+        self.area = area
+        self.unit = unit
+        self.address = address
+        self.dtype = typed[0].lower() if typed else None
+        self.order = typed[1].upper() if len(typed) > 1 else "ABCD"
+        self.words = 1
+        self.priority = Priority.Read
+        self.read = None
+        self.write = None
+        if area in "CI":
+            if typed:
+                raise ValueError("Coils and inputs can not be typed: %s" % name)
+            self.decode = _decode_bits
+            self.encode = _encode_bit
+        elif self.dtype is None:
+            self.decode = _decode_registers
+            self.encode = _encode_register
+        else:
+            if self.dtype not in TYPES or self.order not in ORDERS:
+                raise ValueError("Invalid Modbus address: %s" % name)
+            if np is None:
+                raise RuntimeError("Typed Modbus addresses require numpy")
+            self.words = int(TYPES[self.dtype][-1]) // 2
+            self.decode = self._decode_typed
+            self.encode = self._encode_typed
+
+    def bind(self, connection, keyword="unit"):
+        """Binds the read and write methods of `connection` for this area.
+
+        @arg connection a `ahio.connection_pool.SharedConnection`.
+        @arg keyword the client's device keyword, see `unit_keyword`.
+        """
+        request = connection.request
+        unit = {keyword: self.unit}
+        reader = _READERS[self.area]
+        self.read = functools.partial(request, self.priority, reader, **unit)
+        writer = _WRITERS[self.area]
+        if writer and self.dtype:
+            writer = "write_registers"
+        if writer:
+            # interlock pins keep their priority, other writes use Write
+            priority = min(self.priority, Priority.Write, key=lambda p: p.value)
+            self.write = functools.partial(request, priority, writer, **unit)
+        else:
+            self.write = None
+
+    def _decode_typed(self, ret):
+        if not getattr(ret, "registers", None):
+            return 0
+        return decode_registers(ret.registers, self.dtype, self.order)[0].item()
+
+    def _encode_typed(self, value):
+        return encode_registers(value, self.dtype, self.order)
+
+
 class Driver(ahio.abstract_driver.AbstractDriver):
     _client = None
+    _key = None
+    _keyword = "unit"
     _ports_direction = dict()
     _ports_type = dict()
 
+    def __init__(self):
+        self._addresses = {}
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         if self._client:
-            self._client.close()
+            ahio.connection_pool.pool.release(self._key)
             self._client = None
-        pass
+            self._key = None
 
     def setup(
         self,
-        configuration="ModbusSerialClient(method='rtu',port='/dev/cu.usbmodem14101',baudrate=9600)",
+        configuration="ModbusSerialClient(port='/dev/cu.usbmodem14101',baudrate=9600)",
+        shared=True,
+        buffered=False,
     ):
         """Start a Modbus server.
 
@@ -52,25 +263,29 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         parameters:
 
         ModbusTcpClient
-            host: The host to connect to (default 127.0.0.1)
+            host: The host to connect to
             port: The modbus port to connect to (default 502)
-            source_address: The source address tuple to bind to (default ('', 0))
-            timeout: The timeout to use for this socket (default Defaults.Timeout)
+            source_address: The source address tuple to bind to (default None)
+            timeout: The timeout to use for this socket (default 3s)
 
         ModbusUdpClient
-            host: The host to connect to (default 127.0.0.1)
+            host: The host to connect to
             port: The modbus port to connect to (default 502)
-            timeout: The timeout to use for this socket (default None)
+            timeout: The timeout to use for this socket (default 3s)
 
         ModbusSerialClient
-            method: The method to use for connection (asii, rtu, binary)
             port: The serial port to attach to
+            framer: The framing to use (default FramerType.RTU, or
+                    FramerType.ASCII)
             stopbits: The number of stop bits to use (default 1)
             bytesize: The bytesize of the serial messages (default 8 bits)
-            parity: Which kind of parity to use (default None)
-            baudrate: The baud rate to use for the serial device
+            parity: Which kind of parity to use (default 'N')
+            baudrate: The baud rate to use for the serial device (default 19200)
             timeout: The timeout between serial requests (default 3s)
 
+        The configuration is evaluated with only these classes and
+        `FramerType` in scope, other names are not available.
+
         When configuring the ports, the following convention should be
         respected:
 
@@ -83,22 +298,135 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         R = Register
         H = Holding
 
+        Registers (R and H) can be given a type and, for types larger than one
+        register, the order of its bytes:
+
+        portname: H1:13:float32:CDAB -> float in holding registers 13 and 14
+
+        The types are int16, uint16, int32, uint32, int64, uint64, float32
+        and float64, and the orders are ABCD (big-endian, the default), CDAB
+        (words swapped), BADC (bytes swapped) and DCBA (both swapped). Untyped
+        registers are read as a float holding the raw register value.
+
+        Drivers set up with the same configuration share a single client from
+        `ahio.connection_pool.pool`. Their requests are serialized and served
+        by priority, see `set_pin_priority`, and the client is closed when the
+        last of them exits. Block reads are split in requests of at most 125
+        registers, so urgent requests can be served between them.
+
         @arg configuration a string that instantiates one of those classes.
+        @arg shared whether to share the client with other drivers using the
+             same configuration.
+        @arg buffered for ModbusSerialClient, whether to talk to the port
+             through an `ahio.serial_transport.SerialTransport`, which reads
+             ahead and keeps the 3.5 characters of silence Modbus RTU
+             requires between frames.
 
-        @throw RuntimeError can't connect to Arduino
+        @throw RuntimeError if the client can't connect
         """
-        from pymodbus3.client.sync import (
-            ModbusSerialClient,
-            ModbusUdpClient,
-            ModbusTcpClient,
-        )
+        try:
+            from pymodbus.client import (
+                ModbusSerialClient,
+                ModbusUdpClient,
+                ModbusTcpClient,
+            )
+            from pymodbus import FramerType
+        except ImportError:
+            from pymodbus3.client.sync import (
+                ModbusSerialClient,
+                ModbusUdpClient,
+                ModbusTcpClient,
+            )
+
+            FramerType = None
 
-        self._client = eval(configuration)
-        self._client.connect()
+        names = {
+            "ModbusSerialClient": ModbusSerialClient,
+            "ModbusUdpClient": ModbusUdpClient,
+            "ModbusTcpClient": ModbusTcpClient,
+            "FramerType": FramerType,
+        }
+
+        def connect():
+            client = eval(configuration, {}, names)
+            if not client.connect():
+                client.close()
+                raise RuntimeError("Could not connect: %s" % configuration)
+            port = getattr(client, "socket", None)
+            if buffered and hasattr(port, "in_waiting"):
+                client.socket = SerialTransport(port, 3.5 * character_time(port))
+            return client
+
+        if shared:
+            key = ahio.connection_pool.configuration_key(configuration)
+            key = (key, buffered)
+        else:
+            key = object()
+        self._client = ahio.connection_pool.pool.acquire(key, connect)
+        self._key = key
+        self._keyword = unit_keyword(self._client.client)
+        for address in self._addresses.values():
+            address.bind(self._client, self._keyword)
 
     def available_pins(self):
         return []
 
+    def map_pin(self, abstract_pin_id, physical_pin_id):
+        """Maps a pin to a Modbus address, see `AbstractDriver.map_pin`.
+
+        The address is validated and compiled here, so mistakes are reported
+        when mapping instead of in the middle of a scan.
+
+        @throw ValueError if `physical_pin_id` is not a valid Modbus address.
+        """
+        if physical_pin_id:
+            self._address(physical_pin_id)
+        super().map_pin(abstract_pin_id, physical_pin_id)
+
+    def set_pin_priority(self, pin, priority):
+        """Sets the priority of requests to `pin`.
+
+        Requests are served by priority when drivers share a client (see
+        `setup`). Reads default to `ahio.scheduler.Priority.Read` and writes
+        always use at least `ahio.scheduler.Priority.Write`. Mark interlock
+        pins with `Priority.Interlock` so their reads overtake queued writes,
+        and large polls with `Priority.Background` so they yield to the rest.
+
+        @arg pin pin id you've set using `AbstractDriver.map_pin`
+        @arg priority a value from `ahio.scheduler.Priority`
+
+        @throw KeyError if pin isn't mapped.
+        """
+        if type(pin) is list:
+            for p in pin:
+                self.set_pin_priority(p, priority)
+            return
+
+        pin_id = self._pin_mapping.get(pin, None)
+        if not pin_id:
+            raise KeyError("Requested pin is not mapped: %s" % pin)
+        address = self._address(pin_id)
+        address.priority = priority
+        if self._client:
+            address.bind(self._client, self._keyword)
+
+    def request_metrics(self):
+        """Returns the request queueing metrics of the client.
+
+        See `ahio.scheduler.PriorityScheduler.metrics`. The metrics cover
+        every driver sharing the client.
+        """
+        return self._client.scheduler.metrics() if self._client else {}
+
+    def _address(self, pin):
+        address = self._addresses.get(pin, None)
+        if address is None:
+            address = Address(pin)
+            if self._client:
+                address.bind(self._client, self._keyword)
+            self._addresses[pin] = address
+        return address
+
     def _set_pin_direction(self, pin, direction):
         self._ports_direction[pin] = direction
 
@@ -111,28 +439,56 @@ class Driver(ahio.abstract_driver.AbstractDriver):
     def _pin_type(self, pin):
         return self._ports_type[pin]
 
+    def read_block(self, pin, count):
+        """Reads `count` consecutive values starting at `pin`'s address.
+
+        The values have the type of `pin` and are fetched with as few requests
+        as the protocol allows. Register blocks are decoded in a single pass.
+        Interpolation set with `set_pin_interpolation` is not applied.
+
+        @arg pin pin id you've set using `AbstractDriver.map_pin`
+        @arg count how many values to read
+
+        @returns a numpy array for registers or a list of ints for bits.
+
+        @throw KeyError if pin isn't mapped.
+        """
+        pin_id = self._pin_mapping.get(pin, None)
+        if not pin_id:
+            raise KeyError("Requested pin is not mapped: %s" % pin)
+        address = self._address(pin_id)
+        if address.area in "CI":
+            return self._read_bits(address, count)
+        return self._read_registers(address, count)
+
+    def _read_bits(self, address, count):
+        bits = []
+        for start in range(0, count, MAX_BITS):
+            n = min(MAX_BITS, count - start)
+            ret = _check(address.read(address.address + start, count=n))
+            bits.extend(int(b) for b in ret.bits[:n])
+        return bits
+
+    def _read_registers(self, address, count):
+        total = count * address.words
+        step = MAX_REGISTERS - MAX_REGISTERS % address.words
+        registers = []
+        for start in range(0, total, step):
+            n = min(step, total - start)
+            ret = _check(address.read(address.address + start, count=n))
+            registers.extend(ret.registers[:n])
+        return decode_registers(registers, address.dtype or "uint16", address.order)
+
     def _write(self, pin, value, pwm):
-        ptype = pin[0].upper()
-        unit, address = [int(i) for i in pin[1:].split(":")]
-        func = self._client.write_register if ptype == "R" else self._client.write_coil
-        func(address, value, unit=unit)
+        address = self._address(pin)
+        if not address.write:
+            raise RuntimeError("Can not write to Input")
+        _check(address.write(address.address, address.encode(value)))
 
     def _read(self, pin):
-        ptype = pin[0].upper()
-        unit, address = [int(i) for i in pin[1:].split(":")]
-        func = {
-            "C": self._client.read_coils,
-            "I": self._client.read_discrete_inputs,
-            "R": self._client.read_input_registers,
-            "H": self._client.read_holding_registers,
-        }[ptype]
-        ret = func(address, unit=unit)
-        if hasattr(ret, "bits"):
-            return int(ret.bits[0])
-        elif hasattr(ret, "registers"):
-            return float(ret.registers[0])
-        else:
-            return 0
+        address = self._address(pin)
+        ret = _check(address.read(address.address, count=address.words))
+        return address.decode(ret)
 
     def analog_references(self):
         return []
@@ -21,12 +21,31 @@
 # THE SOFTWARE.
 
 import ahio.abstract_driver
+import ahio.gpiomem
 
+import collections
 import os.path
 import platform
+import queue
 import re
+import threading
+import time
 from enum import Enum
 
+# edge events waiting in the queue of each driver, see add_edge_detection
+EVENT_QUEUE_SIZE = 1024
+
+
+class Event(collections.namedtuple("Event", "pin edge value time")):
+    """An edge detected on a pin.
+
+    `pin` is the id given to `map_pin`, `edge` is `Driver.Edges.Rising` or
+    `Driver.Edges.Falling`, `value` is the level read right after the edge and
+    `time` is the `time.monotonic()` of the detection.
+    """
+
+    __slots__ = ()
+
 
 def pi_version():
     """Detect the version of the Raspberry Pi.  Returns either 1, 2 or
@@ -85,10 +104,24 @@ class Driver(ahio.abstract_driver.AbstractDriver):
 
     Pins = Enum("Pins", "D3 D5 D7 D8 D10 D12 D13 D15 D16 D18 D19 D21 D22 D23 D24 D26")
 
-    __pwm = {}
-    __pwm_frequency = {}
+    # edges counted on the pin of the same number, see add_edge_detection
+    Counters = Enum(
+        "Counters", "C3 C5 C7 C8 C10 C12 C13 C15 C16 C18 C19 C21 C22 C23 C24 C26"
+    )
+
+    Edges = Enum("Edges", "Rising Falling Both")
 
     def __init__(self):
+        # live PWM channels and their duty cycles, by pin
+        self.__pwm = {}
+        self.__pwm_duty = {}
+        self.__pwm_frequency = {}
+        self._registers = None
+        self._detections = {}
+        self._counts = {}
+        self._events = queue.Queue(EVENT_QUEUE_SIZE)
+        self._dropped = 0
+        self._events_lock = threading.Lock()
         if ahioDriverInfo.AVAILABLE:
             GPIO.setmode(GPIO.BOARD)
             for pin in Driver.Pins:
@@ -98,6 +131,11 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        for pin in list(self.__pwm):
+            self.__stop_pwm(pin)
+        if self._registers:
+            self._registers.close()
+            self._registers = None
         GPIO.cleanup()
 
     def __create_pin_info(self, pid):
@@ -117,25 +155,144 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         if type(pin) is int:
             return pin
         else:
-            return int(pin.name.replace("D", ""))
+            return int(pin.name[1:])
 
     def __clamp(self, value, min, max):
         return sorted((min, value, max))[1]
 
+    def __stop_pwm(self, pin):
+        pwm = self.__pwm.pop(pin, None)
+        self.__pwm_duty.pop(pin, None)
+        if pwm:
+            pwm.stop()
+
     # pinout used is the second on this link (physical/BOARD pinout):
     # https://www.raspberrypi.org/documentation/usage/gpio
     def available_pins(self):
         return [self.__create_pin_info(pin) for pin in Driver.Pins]
 
+    def use_registers(self, path="/dev/gpiomem"):
+        """Reads and writes lists of pins through the GPIO registers.
+
+        Maps the GPIO register block with `ahio.gpiomem.GPIOMemory`. Reading
+        a list of pins then loads the level of all of them at once, and
+        writing a list of pins sets and clears all of them with one store
+        each, without system calls. Single pins, PWM and directions still go
+        through RPi.GPIO.
+
+        @arg path device to map, any file of at least
+             `ahio.gpiomem.BLOCK_SIZE` bytes can be used for testing.
+
+        @throw OSError if `path` can't be mapped.
+        """
+        registers = ahio.gpiomem.GPIOMemory(path)
+        if self._registers:
+            self._registers.close()
+        self._registers = registers
+
+    def add_edge_detection(self, pin, edge=None, debounce=0, callback=None):
+        """Reports the edges of input `pin` as they happen.
+
+        Edges are detected by the kernel, without polling the pin. Each edge
+        is reported as an `Event`. If `callback` is given, it's called with
+        the event from a thread of RPi.GPIO and should return quickly.
+        Otherwise the event is put in a queue, read with `get_event`. When the
+        queue is full, the oldest event is dropped.
+
+        Edges are also counted. Map a pin to the member of `Driver.Counters`
+        with the same number, like `Driver.Counters.C12` for
+        `Driver.Pins.D12`, to read the count. Writing an int to it sets the
+        count.
+
+        @arg pin pin id you've set using `map_pin`, set as input.
+        @arg edge a value from `Driver.Edges`, defaults to `Driver.Edges.Both`
+        @arg debounce milliseconds after an edge during which new edges are
+             ignored.
+        @arg callback function called with each `Event`.
+
+        @throw KeyError if pin isn't mapped.
+        """
+        edge = edge or Driver.Edges.Both
+        channel = self.__pin_to_int(self._mapped_pin_id(pin))
+        if channel in self._detections:
+            GPIO.remove_event_detect(channel)
+        self._detections[channel] = (pin, edge, callback)
+        self._counts.setdefault(channel, 0)
+        kind = {
+            Driver.Edges.Rising: GPIO.RISING,
+            Driver.Edges.Falling: GPIO.FALLING,
+            Driver.Edges.Both: GPIO.BOTH,
+        }[edge]
+        options = {"bouncetime": int(debounce)} if debounce else {}
+        GPIO.add_event_detect(channel, kind, callback=self._on_edge, **options)
+
+    def remove_edge_detection(self, pin):
+        """Stops reporting and counting the edges of `pin`.
+
+        @throw KeyError if pin isn't mapped.
+        """
+        channel = self.__pin_to_int(self._mapped_pin_id(pin))
+        if self._detections.pop(channel, None):
+            GPIO.remove_event_detect(channel)
+
+    def get_event(self, timeout=None):
+        """Takes the oldest `Event` from the queue, see `add_edge_detection`.
+
+        @arg timeout seconds to wait for an event, None waits forever.
+
+        @returns an `Event`, or None if the timeout expired.
+        """
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def set_event_queue_size(self, size):
+        """Sets how many events the queue holds, dropping those in it."""
+        self._events = queue.Queue(size)
+
+    def event_metrics(self):
+        """Returns the amount of events in the queue and dropped from it."""
+        return {"queued": self._events.qsize(), "dropped": self._dropped}
+
+    def _on_edge(self, channel):
+        now = time.monotonic()
+        detection = self._detections.get(channel, None)
+        if detection is None:
+            return
+        pin, edge, callback = detection
+        value = GPIO.input(channel)
+        if edge == Driver.Edges.Both:
+            edge = Driver.Edges.Rising if value else Driver.Edges.Falling
+        event = Event(pin, edge, value, now)
+        with self._events_lock:
+            self._counts[channel] += 1
+            if callback is None:
+                while True:
+                    try:
+                        self._events.put_nowait(event)
+                        break
+                    except queue.Full:
+                        self._events.get_nowait()
+                        self._dropped += 1
+        if callback is not None:
+            callback(event)
+
     def _set_pin_direction(self, pin, direction):
+        if type(pin) is Driver.Counters:
+            if direction != ahio.Direction.Input:
+                raise RuntimeError("Counters can only be used as Input")
+            return
         pin = self.__pin_to_int(pin)
         if direction == ahio.Direction.Input:
             GPIO.setup(pin, GPIO.IN)
         else:
             GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
-        self.__pwm.pop(pin, None)
+        self.__stop_pwm(pin)
 
     def _pin_direction(self, pin):
+        if type(pin) is Driver.Counters:
+            return ahio.Direction.Input
         pin = self.__pin_to_int(pin)
         function = GPIO.gpio_function(pin)
         if function == GPIO.IN:
@@ -153,6 +310,12 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         return ahio.PortType.Digital
 
     def _write(self, pin, value, pwm):
+        if type(pin) is Driver.Counters:
+            if pwm or type(value) is not int:
+                raise TypeError("Counters can only be set to an int")
+            with self._events_lock:
+                self._counts[self.__pin_to_int(pin)] = value
+            return
         pin = self.__pin_to_int(pin)
         if self._pin_direction(pin) == ahio.Direction.Input:
             return
@@ -165,18 +328,63 @@ class Driver(ahio.abstract_driver.AbstractDriver):
                     if not freq:
                         freq = 1
                     p = GPIO.PWM(pin, freq)
-                p.start(value)
+                    p.start(value)
+                    self.__pwm[pin] = p
+                elif self.__pwm_duty[pin] != value:
+                    p.ChangeDutyCycle(value)
+                self.__pwm_duty[pin] = value
             else:
                 raise TypeError("Value should be a float or int between 0 and 1")
         else:
             if type(value) is ahio.LogicValue:
                 lv = ahio.LogicValue
                 value = GPIO.HIGH if value == lv.High else GPIO.LOW
+                self.__stop_pwm(pin)
                 GPIO.output(pin, value)
             else:
                 raise TypeError("Value should be of type ahio.LogicValue")
 
+    def _write_many(self, pins, values, pwm):
+        if not self._registers or pwm:
+            return super()._write_many(pins, values, pwm)
+        registers = self._registers
+        bcm = ahio.gpiomem.BOARD_TO_BCM
+        high = 0
+        low = 0
+        for pin, value in zip(pins, values):
+            if type(pin) is Driver.Counters:
+                self._write(pin, value, pwm)
+                continue
+            if type(value) is not ahio.LogicValue:
+                raise TypeError("Value should be of type ahio.LogicValue")
+            pin = self.__pin_to_int(pin)
+            self.__stop_pwm(pin)
+            if registers.function(bcm[pin]) != ahio.gpiomem.OUTPUT:
+                continue
+            if value == ahio.LogicValue.High:
+                high |= 1 << bcm[pin]
+            else:
+                low |= 1 << bcm[pin]
+        if high:
+            registers.set(high)
+        if low:
+            registers.clear(low)
+
+    def _read_many(self, pins):
+        if not self._registers:
+            return super()._read_many(pins)
+        levels = self._registers.levels()
+        bcm = ahio.gpiomem.BOARD_TO_BCM
+        return [
+            self._read(pin)
+            if type(pin) is Driver.Counters
+            else (levels >> bcm[self.__pin_to_int(pin)]) & 1
+            for pin in pins
+        ]
+
     def _read(self, pin):
+        if type(pin) is Driver.Counters:
+            return self._counts.get(self.__pin_to_int(pin), 0)
         pin = self.__pin_to_int(pin)
         return GPIO.input(pin)
 
@@ -192,6 +400,8 @@ class Driver(ahio.abstract_driver.AbstractDriver):
     def _set_pwm_frequency(self, frequency, pin):
         if pin:
             pin = self.__pin_to_int(pin)
+            if self.__pwm_frequency.get(pin, None) == frequency:
+                return
             self.__pwm_frequency[pin] = frequency
             pwm = self.__pwm.get(pin, None)
             if pwm:
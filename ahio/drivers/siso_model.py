@@ -23,8 +23,9 @@
 from enum import Enum
 
 import ahio.abstract_driver
+import ahio.clock
+import ahio.state_space
 import numpy as np
-import scipy.signal
 
 
 class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
@@ -33,10 +34,20 @@ class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
 
 
 class Driver(ahio.abstract_driver.AbstractDriver):
+    # pins of single input, single output models. Other models get U1 to Um
+    # and Y1 to Yp, see setup
     Pins = Enum("Pins", "U, Y")
+    # channel of each input and output pin
+    _inputs = {Pins.U: 0}
+    _outputs = {Pins.Y: 0}
     x = None
     u = None
+    y = None
     model = None
+    dt = None
+    clock = None
+    # clock time the state x refers to
+    t = None
 
     def __enter__(self):
         return self
@@ -44,34 +55,64 @@ class Driver(ahio.abstract_driver.AbstractDriver):
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
-    def setup(self, model="([[0.5]], [[1]], [[1]], [[0]], 1)"):
-        self.model = [np.array(x) for x in eval(model)]
-
-        if len(self.model) % 2 == 1:
-            *self.model, dt = self.model
-            dt = float(dt)
-            G = scipy.signal.dlti(*self.model, dt=dt)
-            G = scipy.signal.StateSpace(G)
-            self.model = G.A, G.B, G.C, G.D
-        else:
-            G = scipy.signal.lti(*self.model)
-            G = scipy.signal.StateSpace(G)
-            self.model = G.A, G.B, G.C, G.D
-            vals = scipy.linalg.eigvals(G.A)
-            dt = max(0.1, float("%.1f" % (max(abs(np.real(vals))) / 5)))
-            *self.model, _ = scipy.signal.cont2discrete(self.model, dt)
-
+    def setup(self, model="([[0.5]], [[1]], [[1]], [[0]], 1)", clock=None):
+        """Simulates a linear model.
+
+        `model` is a string with a tuple of arrays accepted by
+        `scipy.signal.lti` (continuous models) or, with the sample time as
+        last element, `scipy.signal.dlti` (discrete models). Continuous models
+        are discretized with a sample time based on their fastest pole. It
+        can also be the path of a `.npz` or `.json` file with the model, see
+        `ahio.state_space.load`. Discretized models are cached, so drivers
+        set up with the same model only convert it once.
+
+        The model advances one sample for each sample time elapsed on `clock`,
+        with the input held between writes. Reading doesn't change the
+        state, so the output can be read any number of times per cycle.
+
+        Models with one input and one output have the pins `Driver.Pins.U`
+        and `Driver.Pins.Y`. Models with m inputs and p outputs have the pins
+        U1 to Um and Y1 to Yp in `self.Pins`, an enum created for the model.
+        Outputs are y = C x + D u.
+
+        @arg model the model, by default a discrete first order system, or the
+             path of a file with it.
+        @arg clock an `ahio.clock.WallClock` (the default) or
+             `ahio.clock.VirtualClock`, advanced by the caller.
+        """
+        *self.model, dt = ahio.state_space.discretize(
+            ahio.state_space.parse(model)
+        )
+        self.model = tuple(self.model)
         A, B, C, D = self.model
-        self.u = 0
-        self.x = np.zeros((A.shape[0], 1))
+        n, m, p = A.shape[0], B.shape[1], C.shape[0]
+        if (m, p) == (1, 1):
+            self.Pins = Driver.Pins
+        else:
+            names = ["U%d" % (i + 1) for i in range(m)]
+            names += ["Y%d" % (i + 1) for i in range(p)]
+            self.Pins = Enum("Pins", " ".join(names))
+        self._inputs = {pin: i for i, pin in enumerate(list(self.Pins)[:m])}
+        self._outputs = {pin: i for i, pin in enumerate(list(self.Pins)[m:])}
+        # state, input and output, updated in place
+        self.x = np.zeros((n, 1))
+        self.u = np.zeros((m, 1))
+        self.y = np.zeros((p, 1))
+        self._ax = np.zeros((n, 1))
+        self._bu = np.zeros((n, 1))
+        self._du = np.zeros((p, 1))
+        self.dt = dt
+        self.clock = clock or ahio.clock.WallClock()
+        self.t = self.clock.now()
 
     def __create_pin_info(self, pid, pwm=False):
+        is_input = pid in self._inputs
         obj = {
             "id": pid,
-            "name": "U" if pid.value == 1 else "Y",
+            "name": pid.name,
             "analog": {
-                "input": pid.value == 2,
-                "output": pid.value == 1,
+                "input": not is_input,
+                "output": is_input,
                 "read_range": (0, 100),
                 "write_range": (0, 100),
             },
@@ -80,14 +121,16 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         return obj
 
     def available_pins(self):
-        pins = [p for p in Driver.Pins]
+        pins = [p for p in self.Pins]
         return [self.__create_pin_info(pin, True) for pin in pins]
 
     def _set_pin_direction(self, pin, direction):
         pass
 
     def _pin_direction(self, pin):
-        return ahio.Direction.Input if pin == 2 else ahio.Direction.Output
+        if pin in self._inputs:
+            return ahio.Direction.Output
+        return ahio.Direction.Input
 
     def _set_pin_type(self, pin, ptype):
         pass
@@ -96,17 +139,73 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         return ahio.PortType.Digital
 
     def _write(self, pin, value, pwm):
-        self.u = value
+        self._write_many([pin], [value], pwm)
+
+    def _write_many(self, pins, values, pwm):
+        # the previous input applies until now
+        self._advance()
+        for pin, value in zip(pins, values):
+            if pin not in self._inputs:
+                raise RuntimeError("Can not write to an output of the model")
+            self.u[self._inputs[pin], 0] = value
+        self._output()
 
     def _read(self, pin):
+        return self._read_many([pin])[0]
+
+    def _read_many(self, pins):
+        self._advance()
+        values = []
+        for pin in pins:
+            if pin in self._outputs:
+                values.append(float(self.y[self._outputs[pin], 0]))
+            else:
+                values.append(float(self.u[self._inputs[pin], 0]))
+        return values
+
+    def simulate(self, u, resume=False):
+        """Simulates the model for a whole input sequence at once.
+
+        The simulation starts from the current state of the driver, and each
+        output is what reading the outputs would return after one more sample
+        with the input at the same position. It's computed by
+        `ahio.state_space.trajectory`, in blocks instead of sample by sample,
+        so long sequences take a fraction of the time of writing and reading
+        the pins.
+
+        @arg u sequence of inputs, one per sample, an array of N x m for
+             models with m inputs.
+        @arg resume whether the driver should continue from the end of the
+             sequence, with the last state and input, as of the current time
+             of its clock. Otherwise its state is left unchanged.
+
+        @returns a numpy array with the output of each sample, N x p for
+        models with p outputs or N elements for a single output.
+        """
+        self._advance()
         A, B, C, D = self.model
-        if A.shape[0] == 1:
-            self.x = A * self.x + B * self.u
-            y = C * self.x
-        else:
-            self.x = A @ self.x + B * self.u
-            y = C @ self.x
-        return float(y.item())
+        u = np.asarray(u, dtype=float).reshape(-1, B.shape[1])
+        states = ahio.state_space.trajectory(A, B, self.x, u)
+        if resume and len(u):
+            self.x[:, 0] = states[-1]
+            self.u[:, 0] = u[-1]
+            self.t = self.clock.now()
+            self._output()
+        y = states @ C.T + u @ D.T
+        return y[:, 0] if C.shape[0] == 1 else y
+
+    def _advance(self):
+        steps = ahio.state_space.samples(self.clock.now() - self.t, self.dt)
+        if steps <= 0:
+            return
+        A, B, C, D = self.model
+        ahio.state_space.advance(A, B, self.x, self.u, steps, self._ax, self._bu)
+        self.t += steps * self.dt
+        self._output()
+
+    def _output(self):
+        A, B, C, D = self.model
+        ahio.state_space.output(C, D, self.x, self.u, self.y, self._du)
 
     def analog_references(self):
         return []
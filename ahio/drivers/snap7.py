@@ -20,6 +20,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import ctypes
+import re
+import struct
 import time
 from enum import Enum
 
@@ -31,33 +34,144 @@ except Exception:
     ahioDriverInfo.AVAILABLE = False
 
 
-def retry_on_job_pending(func):
-    def f(*args, **kargs):
-        exception = None
-        for _ in range(10):
-            try:
-                return func(*args, **kargs)
-            except BaseException as e:
-                exception = e
-                print(f"Retrying, Exception: {e}")
-                time.sleep(100 / 1000)
-                if "Job pending" not in str(exception):
-                    raise exception
-        else:
-            if exception:
-                print("retry failed")
-                raise exception
-
-    return f
-
-
 class ahioDriverInfo(ahio.abstract_driver.AbstractahioDriverInfo):
     NAME = "snap7"
     AVAILABLE = True
 
 
+# most items snap7 accepts in a single multi variable request
+MAX_VARS = 20
+# bytes used by the headers of a multi variable request or response
+MULTI_VARS_HEADER = 19
+# bytes used by each item in a multi variable request or response
+MULTI_VARS_ITEM = 12
+# addresses closer than this many bytes are read together
+RANGE_GAP = 16
+# scan plans kept in cache
+MAX_PLANS = 64
+# error snap7 returns when the client still has a job in progress
+JOB_PENDING = "Job pending"
+
+_ADDRESS = re.compile(
+    r"^(?:DB(?P<db>\d+)\.DB|(?P<area>[DMQI]))(?P<type>[XBWD])(?P<start>\d+)"
+    r"(?:\.(?P<bit>[0-7]))?$"
+)
+_AREAS = {"D": "DB", "M": "MK", "Q": "PA", "I": "PE"}
+_CODECS = {"B": struct.Struct(">B"), "W": struct.Struct(">h"), "D": struct.Struct(">I")}
+_BOTH = [ahio.Direction.Input, ahio.Direction.Output]
+_DIRECTIONS = {
+    "D": _BOTH,
+    "M": _BOTH,
+    "Q": ahio.Direction.Output,
+    "I": ahio.Direction.Input,
+}
+
+
+class RetryPolicy(object):
+    """How requests refused with "Job pending" are retried.
+
+    The first retry waits `delay` seconds and each following one waits
+    `backoff` times longer, up to `max_delay`. After `attempts` tries the
+    error is raised. Area reads are abandoned after waiting `timeout` seconds
+    for the PLC.
+    """
+
+    def __init__(
+        self,
+        attempts=10,
+        delay=0.001,
+        backoff=2.0,
+        max_delay=0.1,
+        timeout=5.0,
+    ):
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    def delays(self):
+        """Yields the time to wait before each retry."""
+        delay = self.delay
+        for _ in range(self.attempts - 1):
+            yield delay
+            delay = min(delay * self.backoff, self.max_delay)
+
+
+class Address(object):
+    """An S7 address compiled from its string form.
+
+    Parsing happens once, when the pin is mapped. The address is immutable
+    and carries a prebound `struct.Struct` to decode and encode its value.
+    See `Driver.setup` for the format.
+    """
+
+    __slots__ = ("name", "area", "db", "start", "bit", "size", "codec", "direction")
+
+    def __init__(self, name):
+        match = _ADDRESS.match(str(name).upper())
+        if not match:
+            raise ValueError("Invalid S7 address: %s" % name)
+        dtype = match.group("type")
+        bit = match.group("bit")
+        if (dtype == "X") != (bit is not None):
+            raise ValueError("Invalid S7 address: %s" % name)
+        area = "D" if match.group("db") is not None else match.group("area")
+        fields = {
+            "name": name,
+            "area": snap7.types.Areas[_AREAS[area]],
+            "db": int(match.group("db") or 0),
+            "start": int(match.group("start")),
+            "bit": int(bit) if bit is not None else None,
+            "size": _CODECS[dtype].size if dtype in _CODECS else 1,
+            "codec": _CODECS.get(dtype, None),
+            "direction": _DIRECTIONS[area],
+        }
+        for field, value in fields.items():
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("S7 addresses are immutable")
+
+    def __repr__(self):
+        return "Address(%r)" % self.name
+
+    def decode(self, buffer, offset=0):
+        """Decodes the value of this address from `buffer` at `offset`."""
+        if self.bit is None:
+            return self.codec.unpack_from(buffer, offset)[0]
+        lv = ahio.LogicValue
+        return lv.High if (buffer[offset] >> self.bit) & 1 else lv.Low
+
+    def encode(self, value):
+        """Returns the bytes to write for `value`.
+
+        Bytes, words and dwords are fully overwritten, so there's no need to
+        read them first. Bits are a single byte holding 0 or 1, written with
+        the S7 bit transport size, which leaves the other bits untouched.
+        Other values are rounded to the nearest integer, as interpolated
+        values are floats.
+        """
+        value = {ahio.LogicValue.High: 1, ahio.LogicValue.Low: 0}.get(value, value)
+        if self.bit is not None:
+            return bytearray([1 if value else 0])
+        return bytearray(self.codec.pack(int(round(value))))
+
+
 class Driver(ahio.abstract_driver.AbstractDriver):
     _client = None
+    _pdu_length = 240
+
+    def __init__(self):
+        self._plans = {}
+        self._addresses = {}
+        self._retry = RetryPolicy()
+        self._metrics = dict.fromkeys(
+            ("requests", "retries", "failures", "timeouts", "wait"), 0
+        )
+        # buffer of the last asynchronous read, snap7 writes into it until
+        # the request completes
+        self._pending = None
 
     def __enter__(self):
         return self
@@ -78,18 +192,36 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         so `available_pins()` returns an empty list. Instead, you should use
         `map_pin()` to map to a Merker, Input or Output in the PLC. The
         internal id you should use is a string following this format:
-        '[DMQI][XBWD][0-9]+.?[0-9]*' where:
+        '[DMQI][XBWD][0-9]+.?[0-7]?' where:
 
         * [DMQI]: D for DB, M for Merker, Q for Output, I for Input
         * [XBWD]: X for bit, B for byte, W for word, D for dword
         * [0-9]+: Address of the resource
-        * [0-9]*: Bit of the address (type X only, ignored in others)
+        * [0-7]: Bit of the address (type X only, required)
+
+        Data blocks other than DB 0 are addressed as 'DB5.DBW10' (word 10 of
+        DB 5) or 'DB5.DBX10.2' (bit 2 of byte 10 of DB 5).
 
         For example: 'IB100' will read a byte from an input at address 100 and
         'MX50.2' will read/write bit 2 of the Merker at address 50. It's not
         allowed to write to inputs (I), but you can read/write Outpus, DBs and
         Merkers. If it's disallowed by the PLC, an exception will be thrown by
-        python-snap7 library.
+        python-snap7 library. Bits are read as `ahio.LogicValue`, bytes and
+        dwords as unsigned and words as signed integers.
+
+        Addresses are checked when mapped, `map_pin()` raises ValueError for
+        invalid ones.
+
+        Requests refused by snap7 with "Job pending" are retried following
+        the driver's `RetryPolicy`, see `set_retry_policy`. Reads of a single
+        pin use snap7's asynchronous API and wait for completion inside
+        snap7, giving up after the policy's timeout. Multi variable reads and
+        writes are synchronous.
+
+        Reading a list of pins with `read` fetches them together: addresses
+        close to each other in the same area are merged into ranges, each
+        range is read once and every pin is decoded from its range. Ranges
+        that fit in a PDU are packed into multi variable requests.
 
         For this library to work, it might be needed to change some settings
         in the PLC itself. See
@@ -113,22 +245,50 @@ class Driver(ahio.abstract_driver.AbstractDriver):
         address = str(address)
         self._client = snap7.client.Client()
         self._client.connect(address, rack, slot, port)
+        self._pdu_length = self._client.get_pdu_length()
 
     def available_pins(self):
         return []
 
+    def set_retry_policy(self, policy):
+        """Sets how requests refused with "Job pending" are retried.
+
+        @arg policy a `RetryPolicy`
+        """
+        self._retry = policy
+
+    def request_metrics(self):
+        """Returns counters of the requests made to the PLC.
+
+        @returns a dictionary with the amount of requests, retries after
+        "Job pending", requests that failed after all retries and completion
+        asynchronous reads that timed out, and the total time in seconds spent
+        waiting to retry.
+        """
+        return dict(self._metrics)
+
+    def map_pin(self, abstract_pin_id, physical_pin_id):
+        """Maps a pin to an S7 address, see `AbstractDriver.map_pin`.
+
+        @throw ValueError if `physical_pin_id` is not a valid S7 address.
+        """
+        if physical_pin_id:
+            self._address(physical_pin_id)
+        super().map_pin(abstract_pin_id, physical_pin_id)
+
+    def _address(self, pin):
+        address = self._addresses.get(pin, None)
+        if address is None:
+            address = self._addresses[pin] = Address(pin)
+        return address
+
     def _set_pin_direction(self, pin, direction):
         d = self._pin_direction(pin)
         if direction != d and not (type(d) is list and direction in d):
             raise RuntimeError("Port %s does not support this Direction" % pin)
 
     def _pin_direction(self, pin):
-        return {
-            "D": [ahio.Direction.Input, ahio.Direction.Output],
-            "M": [ahio.Direction.Input, ahio.Direction.Output],
-            "Q": ahio.Direction.Output,
-            "I": ahio.Direction.Input,
-        }[pin[0].upper()]
+        return self._address(pin).direction
 
     def _set_pin_type(self, pin, ptype):
         raise RuntimeError("Hardware does not support changing the pin type")
@@ -136,24 +296,32 @@ class Driver(ahio.abstract_driver.AbstractDriver):
     def _pin_type(self, pin):
         raise RuntimeError("Hardware does not support querying the pin type")
 
-    @retry_on_job_pending
     def _write(self, pin, value, pwm):
         if pwm:
             raise RuntimeError("Pin does not support PWM")
-        if self._pin_direction(pin) == ahio.Direction.Input:
+        address = self._address(pin)
+        if address.direction == ahio.Direction.Input:
             raise RuntimeError("Can not write to Input")
-        mem = self._parse_port_name(pin)
-        value = {ahio.LogicValue.High: 1, ahio.LogicValue.Low: 0}.get(value, value)
-        self._set_memory(mem, value)
+        self._set_memory(address, value)
+
+    def _write_many(self, pins, values, pwm):
+        if pwm:
+            raise RuntimeError("Pin does not support PWM")
+        addresses = [self._address(pin) for pin in pins]
+        for address in addresses:
+            if address.direction == ahio.Direction.Input:
+                raise RuntimeError("Can not write to Input")
+        data = [a.encode(v) for a, v in zip(addresses, values)]
+        self._write_buffers(addresses, data)
 
-    @retry_on_job_pending
     def _read(self, pin):
-        mem = self._parse_port_name(pin)
-        value = self._get_memory(mem)
-        if mem[1] == "X":
-            return {0: ahio.LogicValue.Low, 1: ahio.LogicValue.High}.get(value, value)
-        else:
-            return value
+        return self._get_memory(self._address(pin))
+
+    def _read_many(self, pins):
+        plan = self._scan_plan(tuple(pins))
+        self._scan(plan)
+        views = plan.views
+        return [address.decode(views[i], offset) for address, i, offset in plan.tags]
 
     def analog_references(self):
         return []
@@ -167,44 +335,203 @@ class Driver(ahio.abstract_driver.AbstractDriver):
     def _set_pwm_frequency(self, frequency, pin):
         raise RuntimeError("Setting PWM frequency is not supported by hardware")
 
-    def _parse_port_name(self, s):
-        s = s.upper()
-        area = {
-            "D": snap7.types.Areas.DB,
-            "M": snap7.types.Areas.MK,
-            "Q": snap7.types.Areas.PA,
-            "I": snap7.types.Areas.PE,
-        }[s[0]]
-        length = {"X": 1, "B": 1, "W": 2, "D": 4}[s[1]]
-        start = int(s.split(".")[0][2:])
-        bit = int(s.split(".")[1]) if s[1] == "X" else None
-        dtype = {
-            "X": {
-                "get": lambda m: snap7.util.get_bool(m, 0, bit),
-                "set": lambda m, v: snap7.util.set_bool(m, 0, bit, v),
-            },
-            "B": {
-                "get": lambda m: snap7.util.get_int(m, 0),
-                "set": lambda m, v: snap7.util.set_int(m, 0, v),
-            },
-            "W": {
-                "get": lambda m: snap7.util.get_int(m, 0),
-                "set": lambda m, v: snap7.util.set_int(m, 0, v),
-            },
-            "D": {
-                "get": lambda m: snap7.util.get_dword(m, 0),
-                "set": lambda m, v: snap7.util.set_dword(m, 0, v),
-            },
-        }[s[1]]
-        return (area, dtype, start, length)
-
-    @retry_on_job_pending
-    def _get_memory(self, mem):
-        m = self._client.read_area(mem[0], 0, mem[2], mem[3])
-        return mem[1]["get"](m)
-
-    @retry_on_job_pending
-    def _set_memory(self, mem, value):
-        m = self._client.read_area(mem[0], 0, mem[2], mem[3])
-        mem[1]["set"](m, value)
-        self._client.write_area(mem[0], 0, mem[2], m)
+    def _get_memory(self, address):
+        a = address
+        return a.decode(self._read_area(a.area, a.db, a.start, a.size))
+
+    def _set_memory(self, address, value):
+        data = address.encode(value)
+        if address.bit is None:
+            a = address
+            self._request(self._client.write_area, a.area, a.db, a.start, data)
+        else:
+            self._write_buffers([address], [data])
+
+    def _request(self, method, *args):
+        """Calls `method(*args)`, retrying it while the client answers
+        "Job pending". This is the only place where requests are retried.
+        """
+        metrics = self._metrics
+        metrics["requests"] += 1
+        delays = self._retry.delays()
+        while True:
+            try:
+                return method(*args)
+            except RuntimeError as e:
+                if JOB_PENDING not in str(e):
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    metrics["failures"] += 1
+                    raise
+                metrics["retries"] += 1
+                metrics["wait"] += delay
+                time.sleep(delay)
+
+    def _read_area(self, area, db, start, size):
+        """Reads `size` bytes with an asynchronous request.
+
+        The request is started and then waited for in snap7, which releases
+        the interpreter lock, for at most the policy's timeout.
+
+        @returns a bytearray with the data read.
+
+        @throw RuntimeError if the request failed or timed out.
+        """
+        buffer = (ctypes.c_uint8 * size)()
+        byte = snap7.types.WordLen.Byte
+        self._request(self._client.as_read_area, area, db, start, size, byte, buffer)
+        # snap7 runs one job at a time, so the previous buffer is no longer
+        # in use once a new request is accepted
+        self._pending = buffer
+        try:
+            self._client.wait_as_completion(int(self._retry.timeout * 1000))
+        except RuntimeError:
+            # the job may still complete and write into the buffer, which is
+            # kept in _pending until then
+            self._metrics["timeouts"] += 1
+            raise
+        self._pending = None
+        return bytearray(buffer)
+
+    def _batches(self, mems, write):
+        """Splits `mems` in groups that fit in a multi variable request.
+
+        A group holds at most `MAX_VARS` items and its request and response
+        must fit in the PDU size negotiated with the PLC.
+        """
+        batch = []
+        used = MULTI_VARS_HEADER
+        for mem in mems:
+            data = 4 + mem.size + mem.size % 2
+            size = MULTI_VARS_ITEM + data if write else max(MULTI_VARS_ITEM, data)
+            if batch and (len(batch) == MAX_VARS or used + size > self._pdu_length):
+                yield batch
+                batch = []
+                used = MULTI_VARS_HEADER
+            batch.append(mem)
+            used += size
+        if batch:
+            yield batch
+
+    def _items(self, mems, write, buffers):
+        """Creates the multi variable request items for `mems`.
+
+        Each item reads into or writes from the bytearray in the same
+        position in `buffers`, without copying.
+
+        @returns the ctypes array of items and the ctypes views of the
+        buffers, which must be kept alive while the items are used.
+        """
+        items = (snap7.types.S7DataItem * len(mems))()
+        views = []
+        for item, mem, buffer in zip(items, mems, buffers):
+            view = (ctypes.c_uint8 * len(buffer)).from_buffer(buffer)
+            item.Area = mem.area.value
+            item.DBNumber = mem.db
+            if write and mem.bit is not None:
+                # bits are addressed as byte * 8 + bit
+                item.WordLen = snap7.types.WordLen.Bit.value
+                item.Start = mem.start * 8 + mem.bit
+                item.Amount = 1
+            else:
+                item.WordLen = snap7.types.WordLen.Byte.value
+                item.Start = mem.start
+                item.Amount = mem.size
+            item.pData = ctypes.cast(view, ctypes.POINTER(ctypes.c_uint8))
+            views.append(view)
+        return items, views
+
+    def _read_buffers(self, mems, buffers):
+        """Reads the memory of all `mems` into `buffers`, a bytearray of the
+        right size for each mem, using multi variable requests.
+        """
+        buffers = iter(buffers)
+        for batch in self._batches(mems, False):
+            batch_buffers = [next(buffers) for _ in batch]
+            items, views = self._items(batch, False, batch_buffers)
+            self._request(self._client.read_multi_vars, items)
+            for item in items:
+                snap7.common.check_error(item.Result, context="client")
+
+    def _write_buffers(self, mems, data):
+        """Writes `data`, a bytearray for each mem, using multi variable
+        requests.
+        """
+        data = iter(data)
+        for batch in self._batches(mems, True):
+            items, views = self._items(batch, True, [next(data) for _ in batch])
+            self._request(self._client.write_multi_vars, list(items))
+
+    def _scan_plan(self, pins):
+        """Returns how to read `pins` in as few requests as possible.
+
+        Addresses of the same area that overlap or are less than `RANGE_GAP`
+        bytes apart are merged into ranges. Ranges small enough to fit in a
+        PDU are read with multi variable requests, the others with a
+        `read_area` each. Plans are cached by the tuple of pins.
+        """
+        plan = self._plans.get(pins, None)
+        if plan is not None:
+            return plan
+
+        addresses = [self._address(pin) for pin in pins]
+        ranges = []
+        for area, db, start, end in sorted(
+            {(a.area.value, a.db, a.start, a.start + a.size) for a in addresses}
+        ):
+            last = ranges[-1] if ranges else None
+            if last and last[:2] == [area, db] and start <= last[3] + RANGE_GAP:
+                last[3] = max(last[3], end)
+            else:
+                ranges.append([area, db, start, end])
+
+        plan = _ScanPlan()
+        plan.buffers = [bytearray(end - start) for *_, start, end in ranges]
+        plan.views = [memoryview(buffer) for buffer in plan.buffers]
+        plan.small = []
+        plan.large = []
+        limit = self._pdu_length - MULTI_VARS_HEADER - 4
+        for index, (area, db, start, end) in enumerate(ranges):
+            mem = _Range(snap7.types.Areas(area), db, start, end - start)
+            if mem.size < limit:
+                plan.small.append((mem, plan.buffers[index]))
+            else:
+                plan.large.append((mem, plan.buffers[index]))
+        plan.tags = []
+        for address in addresses:
+            index = next(
+                i
+                for i, (area, db, start, end) in enumerate(ranges)
+                if (area, db) == (address.area.value, address.db)
+                and start <= address.start < end
+            )
+            plan.tags.append((address, index, address.start - ranges[index][2]))
+
+        if len(self._plans) >= MAX_PLANS:
+            self._plans.clear()
+        self._plans[pins] = plan
+        return plan
+
+    def _scan(self, plan):
+        """Refreshes the buffers of `plan` from the PLC."""
+        if plan.small:
+            mems, buffers = zip(*plan.small)
+            self._read_buffers(mems, buffers)
+        for mem, buffer in plan.large:
+            buffer[:] = self._read_area(mem.area, mem.db, mem.start, mem.size)
+
+
+class _ScanPlan(object):
+    __slots__ = ("buffers", "views", "small", "large", "tags")
+
+
+class _Range(object):
+    __slots__ = ("area", "db", "start", "size", "bit")
+
+    def __init__(self, area, db, start, size):
+        self.area = area
+        self.db = db
+        self.start = start
+        self.size = size
+        self.bit = None
@@ -0,0 +1,125 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""@package ahio.gpiomem
+Direct access to the GPIO registers of the Raspberry Pi.
+
+`/dev/gpiomem` maps the GPIO register block of the BCM2835 family into user
+space without root privileges. Reading all pin levels is then a single 32 bit
+load from GPLEV0 and setting or clearing any number of outputs a single store
+to GPSET0 or GPCLR0, without a system call.
+
+Any file of at least `BLOCK_SIZE` bytes can be mapped in place of the device,
+which lets the register logic be tested on any Linux machine.
+"""
+
+import mmap
+import os
+
+# bytes mapped, a page holding every register below
+BLOCK_SIZE = 4096
+# register offsets, in bytes
+GPFSEL0 = 0x00
+GPSET0 = 0x1C
+GPCLR0 = 0x28
+GPLEV0 = 0x34
+
+# values of the 3 bits of GPFSELn that select a pin function
+INPUT = 0b000
+OUTPUT = 0b001
+
+# BCM GPIO number of each pin of the 40 pin header
+BOARD_TO_BCM = {
+    3: 2,
+    5: 3,
+    7: 4,
+    8: 14,
+    10: 15,
+    11: 17,
+    12: 18,
+    13: 27,
+    15: 22,
+    16: 23,
+    18: 24,
+    19: 10,
+    21: 9,
+    22: 25,
+    23: 11,
+    24: 8,
+    26: 7,
+}
+
+
+class GPIOMemory(object):
+    """The GPIO register block, mapped in memory.
+
+    Pins are given by their BCM number and sets of pins as a bitmask where
+    bit n is BCM pin n. Only pins 0 to 31 are supported, which covers every
+    pin of the header.
+    """
+
+    def __init__(self, path="/dev/gpiomem"):
+        """@arg path device or file to map.
+
+        @throw OSError if `path` can't be opened or mapped.
+        """
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self._map = mmap.mmap(fd, BLOCK_SIZE, mmap.MAP_SHARED)
+        finally:
+            os.close(fd)
+        # 32 bit words, so each access is a single load or store
+        self._words = memoryview(self._map).cast("I")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def levels(self):
+        """Returns the level of every pin as a bitmask."""
+        return self._words[GPLEV0 // 4]
+
+    def set(self, mask):
+        """Sets the outputs in `mask` high, leaving the others untouched."""
+        self._words[GPSET0 // 4] = mask
+
+    def clear(self, mask):
+        """Sets the outputs in `mask` low, leaving the others untouched."""
+        self._words[GPCLR0 // 4] = mask
+
+    def function(self, pin):
+        """Returns the function of `pin`, like `INPUT` or `OUTPUT`."""
+        register, shift = divmod(pin, 10)
+        return (self._words[GPFSEL0 // 4 + register] >> (3 * shift)) & 0b111
+
+    def set_function(self, pin, function):
+        register, shift = divmod(pin, 10)
+        index = GPFSEL0 // 4 + register
+        word = self._words[index] & ~(0b111 << (3 * shift))
+        self._words[index] = word | (function << (3 * shift))
+
+    def close(self):
+        if self._map is not None:
+            self._words.release()
+            self._map.close()
+            self._map = None
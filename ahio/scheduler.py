@@ -0,0 +1,133 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""@package ahio.scheduler
+Serves requests to a shared link by priority class.
+
+On slow links, like a Modbus RTU bus, a long background poll can hold back an
+urgent write for seconds if requests are served in call order. The
+`PriorityScheduler` hands the link to the waiting request with the highest
+priority instead, and to the oldest one among requests of the same priority.
+A request that is already on the wire is never interrupted.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from enum import Enum
+
+# lower values are served first
+Priority = Enum("Priority", "Interlock Write Read Background")
+
+
+class _ClassMetrics(object):
+    __slots__ = ("depth", "max_depth", "served", "total_wait", "max_wait")
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.served = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class PriorityScheduler(object):
+    """Grants exclusive access to a resource, highest priority first."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._busy = False
+        self._metrics = {p: _ClassMetrics() for p in Priority}
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self, priority=Priority.Read):
+        """Blocks until the resource is granted to the caller.
+
+        @arg priority a value from `Priority`.
+        """
+        metrics = self._metrics[priority]
+        start = time.monotonic()
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                metrics.served += 1
+                return
+            waiter = threading.Lock()
+            waiter.acquire()
+            entry = (priority.value, next(self._sequence), priority, waiter)
+            heapq.heappush(self._queue, entry)
+            metrics.depth += 1
+            metrics.max_depth = max(metrics.max_depth, metrics.depth)
+        # released by the previous owner, which hands the resource over
+        waiter.acquire()
+        wait = time.monotonic() - start
+        with self._lock:
+            metrics.served += 1
+            metrics.total_wait += wait
+            metrics.max_wait = max(metrics.max_wait, wait)
+
+    def release(self):
+        with self._lock:
+            if self._queue:
+                *_, priority, waiter = heapq.heappop(self._queue)
+                self._metrics[priority].depth -= 1
+                waiter.release()
+            else:
+                self._busy = False
+
+    def request(self, priority, func, *args, **kwargs):
+        """Calls `func(*args, **kwargs)` once the resource is granted."""
+        self.acquire(priority)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release()
+
+    def metrics(self):
+        """Returns queueing metrics for each priority class.
+
+        @returns a dictionary keyed by the `Priority` names, each value being a
+        dictionary with the current and maximum queue depth, the amount of
+        requests served and their total, mean and maximum waiting time in
+        seconds.
+        """
+        with self._lock:
+            return {
+                p.name: {
+                    "depth": m.depth,
+                    "max_depth": m.max_depth,
+                    "served": m.served,
+                    "total_wait": m.total_wait,
+                    "mean_wait": m.total_wait / m.served if m.served else 0.0,
+                    "max_wait": m.max_wait,
+                }
+                for p, m in self._metrics.items()
+            }
@@ -0,0 +1,153 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""@package ahio.serial_transport
+Buffered serial port for request/response protocols.
+
+Drivers that talk to devices on a serial port exchange small frames, and
+pyserial makes a system call for every write and read. `SerialTransport`
+wraps a `serial.Serial` and:
+
+* sends the writes made inside `SerialTransport.batch` in a single call,
+* reads ahead everything the port has received, serving the next reads from
+  memory,
+* reads frames of known length with `SerialTransport.read_exactly`,
+* keeps a minimum silence between frames, as Modbus RTU requires.
+
+It has the interface of `serial.Serial`, so it can replace one. Attributes it
+doesn't define, like `is_open` or `dtr`, are the port's.
+"""
+
+import contextlib
+import threading
+import time
+
+
+def character_time(port):
+    """Seconds it takes to send one character on `port`, a `serial.Serial`."""
+    bits = 1 + port.bytesize + port.stopbits + (port.parity != "N")
+    return bits / port.baudrate
+
+
+class SerialTransport(object):
+    """Buffers the reads and writes of a serial port."""
+
+    def __init__(self, port, gap=0.0):
+        """@arg port an open `serial.Serial`.
+        @arg gap minimum silence before sending a frame, in seconds. Modbus
+             RTU requires 3.5 times `character_time`.
+        """
+        self.port = port
+        self.gap = gap
+        # system calls made, to measure the effect of buffering
+        self.counters = {"reads": 0, "writes": 0}
+        self._incoming = bytearray()
+        self._outgoing = bytearray()
+        self._batches = 0
+        self._last = 0.0
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.port.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return len(self._incoming) + self.port.in_waiting
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Holds writes made inside the block and sends them together at its
+        end. Reading sends the writes held so far first.
+        """
+        with self._lock:
+            self._batches += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batches -= 1
+                if not self._batches:
+                    self.flush()
+
+    def write(self, data):
+        with self._lock:
+            self._outgoing += data
+            if not self._batches:
+                self.flush()
+        return len(data)
+
+    def flush(self):
+        """Sends the writes held by `batch`."""
+        with self._lock:
+            if not self._outgoing:
+                return
+            if self.gap:
+                wait = self._last + self.gap - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            self.port.write(self._outgoing)
+            self.counters["writes"] += 1
+            self._outgoing = bytearray()
+            self._last = time.monotonic()
+
+    def read(self, size=1):
+        """Reads up to `size` bytes, waiting at most `timeout` seconds."""
+        self.flush()
+        missing = size - len(self._incoming)
+        if missing > 0:
+            # take whatever else has arrived too
+            chunk = self.port.read(max(missing, self.port.in_waiting))
+            self.counters["reads"] += 1
+            if chunk:
+                self._incoming += chunk
+                self._last = time.monotonic()
+        data = bytes(self._incoming[:size])
+        del self._incoming[:size]
+        return data
+
+    def read_exactly(self, size):
+        """Reads `size` bytes.
+
+        @throw RuntimeError if they don't arrive within `timeout` seconds. The
+               bytes that did arrive are kept for the next read.
+        """
+        data = self.read(size)
+        if len(data) != size:
+            self._incoming[:0] = data
+            raise RuntimeError("Serial port read timed out")
+        return data
+
+    def reset_input_buffer(self):
+        self._incoming = bytearray()
+        self.port.reset_input_buffer()
+
+    def close(self):
+        self._incoming = bytearray()
+        self._outgoing = bytearray()
+        self.port.close()
@@ -0,0 +1,343 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""@package ahio.simulators.arduino_emulator
+Arduino emulator for the Arduino driver.
+
+The emulator speaks the protocol of the AHIOForArduino firmware on a
+pseudo-terminal, so the driver can be tested and benchmarked without a board.
+It implements every command of the firmware, including bulk reads and
+streaming, and delays each byte by the time it would take on a serial link
+of the given baud rate. Pseudo-terminals are only available on POSIX
+systems.
+
+\\verbatim
+with ArduinoEmulator() as arduino:
+    arduino.analog[0] = 512
+    with ahio.new_driver("Arduino") as driver:
+        driver.setup(arduino.serve())
+\\endverbatim
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+import tty
+
+from ahio.simulators import _best_time
+
+DIGITAL_PINS = 14
+ANALOG_PINS = 6
+STREAM_MAX_BLOCK = 32
+STREAM_OVERRUN = 0x01
+STREAM_END = 0x80
+
+# bytes following each command
+ARGUMENTS = {
+    0xC1: 0,
+    0xC2: 1,
+    0xC3: 2,
+    0xC4: 1,
+    0xC5: 1,
+    0xC6: 1,
+    0xC7: 2,
+    0xC8: 2,
+    0xC9: 0,
+    0xCA: 0,
+    0xCB: 6,
+    0xCC: 0,
+    0xCD: 2,
+}
+
+
+class ArduinoEmulator(object):
+    """Emulated Arduino UNO running AHIOForArduino.
+
+    The state of the board is in the attributes `digital` (14 values, 0 or
+    1), `analog` (6 values from 0 to 1023), `modes` (20 values, 1 for input
+    and 0 for output, analog pins last), `pwm` (14 duty cycles from 0 to 255) and `reference`,
+    and can be changed at any time, also while serving. Writes to output pins
+    change `digital`. Set `signal` to a function of time and channel to
+    stream something other than the constant values in `analog`.
+    """
+
+    def __init__(self, baudrate=115200, boot_delay=0.0):
+        """@arg baudrate baud rate of the emulated link, each byte takes 10
+             bits. None for no delay.
+        @arg boot_delay seconds the board ignores the port after the first
+             byte arrives, like a board that resets when the port is opened.
+        """
+        self.digital = [0] * DIGITAL_PINS
+        self.analog = [0] * ANALOG_PINS
+        self.modes = [1] * (DIGITAL_PINS + ANALOG_PINS)
+        self.pwm = [0] * DIGITAL_PINS
+        self.reference = 0
+        self.signal = None
+        self.commands = 0
+        self.byte_time = 10 / baudrate if baudrate else 0.0
+        self.boot_delay = boot_delay
+        self._pty = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stream = None
+        # bytes waiting to be sent, like in the UART's transmit buffer
+        self._outbox = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def serve(self):
+        """Starts the board on a pseudo-terminal.
+
+        @returns the path of the serial device the driver should open.
+        """
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._pty = (master, slave)
+        for target in (self._serve, self._transmit):
+            thread = threading.Thread(target=target, args=(master,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return os.ttyname(slave)
+
+    def _serve(self, fd):
+        started = None
+        handshaken = False
+        buffer = bytearray()
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            self._wire(len(data))
+            started = started or time.monotonic()
+            if time.monotonic() - started < self.boot_delay:
+                continue
+            buffer += data
+            while buffer:
+                if not handshaken:
+                    # setup() only waits for the handshake
+                    handshaken = buffer.pop(0) == 0x01
+                    if handshaken:
+                        self._send(b"\x06")
+                    continue
+                if buffer[0] != 0x02:
+                    if buffer.pop(0) == 0x01:
+                        self._send(b"\x06")
+                    continue
+                if len(buffer) < 2:
+                    break
+                size = 2 + ARGUMENTS.get(buffer[1], 0)
+                if len(buffer) < size:
+                    break
+                command, args = buffer[1], bytes(buffer[2:size])
+                del buffer[:size]
+                with self._lock:
+                    self.commands += 1
+                    answer = self.execute(command, args)
+                if answer:
+                    self._send(answer)
+
+    def _wire(self, size):
+        if self.byte_time:
+            time.sleep(size * self.byte_time)
+
+    def _send(self, data):
+        self._outbox.put(data)
+
+    def _transmit(self, fd):
+        while True:
+            data = self._outbox.get()
+            if data is None:
+                return
+            self._wire(len(data))
+            try:
+                os.write(fd, data)
+            except OSError:
+                return
+
+    def execute(self, command, args):
+        """Runs `command` with the bytes `args` and returns the answer."""
+        if command == 0xC1:
+            return bytes([self.reference])
+        elif command == 0xC2:
+            self.reference = args[0]
+        elif command == 0xC3:
+            self.modes[args[0]] = 1 if args[1] else 0
+        elif command == 0xC4:
+            return bytes([self.modes[args[0]]])
+        elif command == 0xC5:
+            return bytes([self.digital[args[0]]])
+        elif command == 0xC6:
+            # like analogRead, which also accepts pin numbers. Channels
+            # without an analog input read 0
+            channel = args[0] - DIGITAL_PINS if args[0] >= DIGITAL_PINS else args[0]
+            value = self.analog[channel] if channel < ANALOG_PINS else 0
+            return value.to_bytes(2, "big")
+        elif command in (0xC7, 0xC8):
+            pin, value = args
+            if command == 0xC8:
+                self.pwm[pin] = value
+                value = value >= 128
+            if not self.modes[pin]:
+                self.digital[pin] = 1 if value else 0
+        elif command == 0xC9:
+            bits = sum(1 << pin for pin, v in enumerate(self.digital) if v)
+            return bits.to_bytes(2, "little")
+        elif command == 0xCA:
+            values = b"".join(v.to_bytes(2, "big") for v in self.analog)
+            return bytes([ANALOG_PINS]) + values
+        elif command == 0xCB:
+            mask, period, block = args[0], int.from_bytes(args[1:5], "big"), args[5]
+            self._start_stream(mask, period / 1e6, block)
+        elif command == 0xCC:
+            return self._stop_stream()
+        elif command == 0xCD:
+            mask = int.from_bytes(args, "little")
+            for pin in range(DIGITAL_PINS):
+                self.modes[pin] = (mask >> pin) & 1
+                if not self.modes[pin]:
+                    self.digital[pin] = 0
+        return None
+
+    def _start_stream(self, mask, period, block):
+        channels = [c for c in range(ANALOG_PINS) if mask & (1 << c)]
+        block = min(max(block, 1), STREAM_MAX_BLOCK)
+        stream = _Stream(channels, period, block)
+        self._stream = stream
+        thread = threading.Thread(target=self._sample, args=(stream,))
+        thread.daemon = True
+        thread.start()
+
+    def _stop_stream(self):
+        stream = self._stream
+        sequence = 0
+        if stream:
+            stream.running = False
+            sequence = stream.sequence
+            self._stream = None
+        return _frame(sequence, STREAM_END, [])
+
+    def _sample(self, stream):
+        start = time.monotonic()
+        due = start
+        samples = []
+        flags = 0
+        while stream.running:
+            now = time.monotonic()
+            if now < due:
+                time.sleep(due - now)
+                continue
+            if now - due >= stream.period:
+                # missed at least one sample, restart the schedule from now
+                flags |= STREAM_OVERRUN
+                due = now
+            due += stream.period
+            signal = self.signal
+            if signal:
+                samples.append([signal(now - start, c) for c in stream.channels])
+            else:
+                samples.append([self.analog[c] for c in stream.channels])
+            if len(samples) == stream.block:
+                frame = _frame(stream.sequence, flags, samples)
+                with self._lock:
+                    # a stopped stream sends nothing after its end frame
+                    if not stream.running:
+                        return
+                    stream.sequence = (stream.sequence + 1) & 0xFF
+                    self._send(frame)
+                samples = []
+                flags = 0
+
+    def close(self):
+        """Stops the board and closes the pseudo-terminal."""
+        if self._stream:
+            self._stream.running = False
+            self._stream = None
+        self._outbox.put(None)
+        if self._pty:
+            for fd in self._pty:
+                os.close(fd)
+            self._pty = None
+        for thread in self._threads:
+            thread.join(1)
+        self._threads = []
+
+
+class _Stream(object):
+    __slots__ = ("channels", "period", "block", "sequence", "running")
+
+    def __init__(self, channels, period, block):
+        self.channels = channels
+        self.period = period
+        self.block = block
+        self.sequence = 0
+        self.running = True
+
+
+def _frame(sequence, flags, samples):
+    data = bytes([sequence, flags, len(samples)])
+    data += b"".join(int(v).to_bytes(2, "big") for s in samples for v in s)
+    return b"\xA5\x5A" + data + bytes([sum(data) & 0xFF])
+
+
+def benchmark(baudrate=115200, repeat=3):
+    """Compares reading every pin one by one and all together.
+
+    @arg baudrate baud rate of the emulated link.
+    @arg repeat how many times to run each measurement, the best is kept.
+
+    @returns a dictionary with the best time, in seconds, of each method and
+    of the connection.
+    """
+    import ahio
+
+    with ArduinoEmulator(baudrate) as arduino:
+        arduino.analog = list(range(0, 1200, 200))
+        path = arduino.serve()
+        results = {}
+        with ahio.new_driver("Arduino") as driver:
+            start = time.perf_counter()
+            driver.setup(path)
+            results["setup"] = time.perf_counter() - start
+            pins = list(driver.Pins)
+            for pin in pins:
+                driver.map_pin(pin, pin)
+            for name, scan in (
+                ("single", lambda: [driver.read(pin) for pin in pins]),
+                ("bulk", lambda: driver.read(pins)),
+            ):
+                results[name] = _best_time(scan, repeat)
+        return results
+
+
+if __name__ == "__main__":
+    baudrate = int(sys.argv[1]) if len(sys.argv) > 1 else 115200
+    for name, seconds in benchmark(baudrate).items():
+        print("%-8s %8.2f ms" % (name, 1e3 * seconds))
@@ -0,0 +1,397 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""@package ahio.simulators.modbus_server
+Modbus slave simulator for the Modbus driver.
+
+The simulator keeps coils, discrete inputs, input registers and holding
+registers in memory and answers Modbus TCP on a local socket and Modbus RTU on
+a pseudo-terminal. It implements the function codes used by the driver (1 to 6,
+15 and 16), can delay every answer and can answer chosen requests with a
+Modbus exception. It doesn't depend on pymodbus' server, so it behaves the same
+with every pymodbus version.
+
+\\verbatim
+with ModbusSimulator(holding_registers=10000) as sim:
+    sim.load("H", 0, range(10000))
+    host, port = sim.serve_tcp()
+    with ahio.new_driver("Modbus") as modbus:
+        modbus.setup("ModbusTcpClient('%s', port=%d)" % (host, port))
+\\endverbatim
+"""
+
+import array
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import tty
+
+from ahio.simulators import _best_time
+
+# exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+DEVICE_FAILURE = 4
+DEVICE_BUSY = 6
+
+
+def crc16(data):
+    """Modbus RTU CRC of `data`."""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+class ModbusSimulator(object):
+    """In memory Modbus slave.
+
+    The areas are available as the attributes `coils` and `discrete_inputs`
+    (a `bytearray` with one byte per bit) and `input_registers` and
+    `holding_registers` (an `array.array` of unsigned 16 bits integers), and
+    can be changed at any time, also while serving.
+    """
+
+    def __init__(
+        self,
+        coils=65536,
+        discrete_inputs=65536,
+        input_registers=65536,
+        holding_registers=65536,
+        delay=0.0,
+        units=None,
+    ):
+        """@arg coils amount of coils.
+        @arg discrete_inputs amount of discrete inputs.
+        @arg input_registers amount of input registers.
+        @arg holding_registers amount of holding registers.
+        @arg delay seconds to wait before answering each request.
+        @arg units device ids to answer to, None for all.
+        """
+        self.coils = bytearray(coils)
+        self.discrete_inputs = bytearray(discrete_inputs)
+        self.input_registers = array.array("H", bytes(2 * input_registers))
+        self.holding_registers = array.array("H", bytes(2 * holding_registers))
+        self.delay = delay
+        self.units = units
+        self.requests = 0
+        self._faults = []
+        self._lock = threading.Lock()
+        self._tcp = None
+        self._pty = None
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def area(self, name):
+        """Returns the area named C, I, R or H, as in the driver's addresses."""
+        return {
+            "C": self.coils,
+            "I": self.discrete_inputs,
+            "R": self.input_registers,
+            "H": self.holding_registers,
+        }[name.upper()]
+
+    def load(self, name, address, values):
+        """Writes `values` to area `name` starting at `address`.
+
+        @arg name C, I, R or H, as in the driver's addresses.
+        @arg address first address to write.
+        @arg values an iterable of ints.
+        """
+        area = self.area(name)
+        if type(area) is bytearray:
+            values = bytes(1 if v else 0 for v in values)
+        else:
+            values = array.array("H", values)
+        with self._lock:
+            area[address : address + len(values)] = values
+
+    def inject_exception(self, code, function=None, address=None, times=None):
+        """Answers matching requests with the exception `code`.
+
+        @arg code Modbus exception code to answer with.
+        @arg function only requests with this function code, None for all.
+        @arg address only requests whose range contains this address, None
+             for all.
+        @arg times how many requests to fail, None for all of them.
+        """
+        with self._lock:
+            self._faults.append([code, function, address, times])
+
+    def clear_exceptions(self):
+        with self._lock:
+            self._faults = []
+
+    def process(self, unit, pdu):
+        """Executes the request `pdu` and returns the response PDU.
+
+        Returns None if the request is addressed to a unit that is not
+        simulated, in which case no answer should be sent.
+        """
+        if self.units is not None and unit not in self.units:
+            return None
+        if self.delay:
+            time.sleep(self.delay)
+        function = pdu[0]
+        with self._lock:
+            self.requests += 1
+            try:
+                if len(pdu) < 5:
+                    raise _ModbusError(ILLEGAL_VALUE)
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                self._fault(function, address, value)
+                return bytes([function]) + self._execute(function, address, value, pdu)
+            except _ModbusError as e:
+                return bytes([function | 0x80, e.code])
+
+    def _fault(self, function, address, value):
+        count = value if function in (1, 2, 3, 4, 15, 16) else 1
+        for fault in self._faults:
+            code, f, a, times = fault
+            if f is not None and f != function:
+                continue
+            if a is not None and not address <= a < address + count:
+                continue
+            if times is not None:
+                if times <= 0:
+                    continue
+                fault[3] -= 1
+            raise _ModbusError(code)
+
+    def _execute(self, function, address, value, pdu):
+        if function in (1, 2):
+            area = self.coils if function == 1 else self.discrete_inputs
+            self._check(area, address, value, 2000)
+            bits = area[address : address + value]
+            packed = bytearray((value + 7) // 8)
+            for i, bit in enumerate(bits):
+                if bit:
+                    packed[i >> 3] |= 1 << (i & 7)
+            return bytes([len(packed)]) + bytes(packed)
+        elif function in (3, 4):
+            area = self.holding_registers if function == 3 else self.input_registers
+            self._check(area, address, value, 125)
+            registers = area[address : address + value]
+            if sys.byteorder == "little":
+                registers.byteswap()
+            return bytes([2 * value]) + registers.tobytes()
+        elif function == 5:
+            if value not in (0x0000, 0xFF00):
+                raise _ModbusError(ILLEGAL_VALUE)
+            self._check(self.coils, address, 1, 1)
+            self.coils[address] = 1 if value else 0
+            return pdu[1:5]
+        elif function == 6:
+            self._check(self.holding_registers, address, 1, 1)
+            self.holding_registers[address] = value
+            return pdu[1:5]
+        elif function == 15:
+            self._check(self.coils, address, value, 1968)
+            packed = pdu[6 : 6 + pdu[5]]
+            if len(packed) < (value + 7) // 8:
+                raise _ModbusError(ILLEGAL_VALUE)
+            for i in range(value):
+                self.coils[address + i] = (packed[i >> 3] >> (i & 7)) & 1
+            return pdu[1:5]
+        elif function == 16:
+            self._check(self.holding_registers, address, value, 123)
+            registers = array.array("H", pdu[6 : 6 + pdu[5]])
+            if len(registers) < value:
+                raise _ModbusError(ILLEGAL_VALUE)
+            if sys.byteorder == "little":
+                registers.byteswap()
+            self.holding_registers[address : address + value] = registers[:value]
+            return pdu[1:5]
+        raise _ModbusError(ILLEGAL_FUNCTION)
+
+    def _check(self, area, address, count, maximum):
+        if not 1 <= count <= maximum:
+            raise _ModbusError(ILLEGAL_VALUE)
+        if address + count > len(area):
+            raise _ModbusError(ILLEGAL_ADDRESS)
+
+    def serve_tcp(self, host="127.0.0.1", port=0):
+        """Starts answering Modbus TCP requests.
+
+        @arg host address to listen on.
+        @arg port port to listen on, 0 picks a free one.
+
+        @returns the (host, port) tuple the simulator is listening on.
+        """
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                while True:
+                    header = _receive(self.request, 7)
+                    if not header:
+                        return
+                    tid, pid, length, unit = struct.unpack(">HHHB", header)
+                    pdu = _receive(self.request, length - 1)
+                    if pdu is None:
+                        return
+                    response = simulator.process(unit, pdu)
+                    if response is None:
+                        continue
+                    header = struct.pack(">HHHB", tid, pid, len(response) + 1, unit)
+                    self.request.sendall(header + response)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._tcp = Server((host, port), Handler)
+        thread = threading.Thread(target=self._tcp.serve_forever, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self._tcp.server_address
+
+    def serve_rtu(self):
+        """Starts answering Modbus RTU requests on a pseudo-terminal.
+
+        Only available on POSIX systems.
+
+        @returns the path of the serial device clients should open.
+        """
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._pty = (master, slave)
+        thread = threading.Thread(target=self._serve_rtu, args=(master,), daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return os.ttyname(slave)
+
+    def _serve_rtu(self, fd):
+        buffer = bytearray()
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while len(buffer) >= 8:
+                function = buffer[1] & 0x7F
+                if function in (15, 16):
+                    if len(buffer) < 7:
+                        break
+                    size = 9 + buffer[6]
+                else:
+                    size = 8
+                if len(buffer) < size:
+                    break
+                frame = bytes(buffer[:size])
+                if crc16(frame[:-2]) != struct.unpack("<H", frame[-2:])[0]:
+                    # lost synchronization, drop a byte and try again
+                    del buffer[0]
+                    continue
+                del buffer[:size]
+                response = self.process(frame[0], frame[1:-2])
+                if response is None:
+                    continue
+                response = frame[:1] + response
+                os.write(fd, response + struct.pack("<H", crc16(response)))
+
+    def close(self):
+        """Stops serving and closes sockets and pseudo-terminals."""
+        if self._tcp:
+            self._tcp.shutdown()
+            self._tcp.server_close()
+            self._tcp = None
+        if self._pty:
+            for fd in self._pty:
+                os.close(fd)
+            self._pty = None
+        for thread in self._threads:
+            thread.join(1)
+        self._threads = []
+
+
+class _ModbusError(Exception):
+    def __init__(self, code):
+        self.code = code
+
+
+def _receive(sock, size):
+    data = b""
+    while len(data) < size:
+        try:
+            chunk = sock.recv(size - len(data))
+        except OSError:
+            return None
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def benchmark(count=1000, delay=0.0, repeat=3):
+    """Compares reading `count` registers one by one and as a block.
+
+    @arg count amount of registers to read.
+    @arg delay delay of the simulator for each request, in seconds.
+    @arg repeat how many times to run each measurement, the best is kept.
+
+    @returns a dictionary with the best time, in seconds, of each method.
+    """
+    import ahio
+
+    with ModbusSimulator(delay=delay) as simulator:
+        simulator.load("H", 0, range(count))
+        host, port = simulator.serve_tcp()
+        configuration = "ModbusTcpClient('%s', port=%d)" % (host, port)
+        with ahio.new_driver("Modbus") as modbus:
+            modbus.setup(configuration, shared=False)
+            pins = list(range(count))
+            for pin in pins:
+                modbus.map_pin(("benchmark", pin), "H1:%d" % pin)
+            pins = [("benchmark", pin) for pin in pins]
+            results = {}
+            for name, scan in (
+                ("single", lambda: modbus.read(pins)),
+                ("block", lambda: modbus.read_block(pins[0], count)),
+            ):
+                results[name] = _best_time(scan, repeat)
+            for pin in pins:
+                modbus.map_pin(pin, None)
+            return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    for name, seconds in benchmark(count, delay).items():
+        print("%-8s %8.2f ms  %8.1f us/register" % (name, 1e3 * seconds, 1e6 * seconds / count))
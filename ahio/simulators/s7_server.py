@@ -0,0 +1,256 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""@package ahio.simulators.s7_server
+Siemens S7 PLC simulator for the snap7 driver.
+
+The simulator runs the server bundled with python-snap7 in the current
+process, with data blocks, Merkers, inputs and outputs of configurable size.
+It can add latency to every request, like a PLC on a slow network, and can
+keep a client busy so its next requests are refused with "Job pending".
+
+\\verbatim
+with S7Simulator(dbs={0: 4096, 5: 1024}) as sim:
+    sim.load("M", 0, range(100))
+    host, port = sim.serve()
+    with ahio.new_driver("snap7") as plc:
+        plc.setup(host, 0, 1, port)
+\\endverbatim
+"""
+
+import ctypes
+import socket
+import sys
+import threading
+import time
+
+import snap7
+
+from ahio.simulators import _best_time
+
+
+class S7Simulator(object):
+    """In memory S7 PLC.
+
+    The areas are available as the attributes `dbs` (a dictionary of data
+    blocks by number), `merkers`, `inputs` and `outputs`, each a ctypes array
+    of bytes shared with the server. They can be changed at any time, also
+    while serving.
+    """
+
+    def __init__(
+        self, dbs=None, merkers=4096, inputs=4096, outputs=4096, latency=0.0
+    ):
+        """@arg dbs dictionary with the size of each data block by number,
+             defaults to a DB 0 of 4096 bytes.
+        @arg merkers size of the Merker area.
+        @arg inputs size of the input area.
+        @arg outputs size of the output area.
+        @arg latency seconds to delay each request by.
+        """
+        dbs = {0: 4096} if dbs is None else dbs
+        self.dbs = {n: (ctypes.c_uint8 * size)() for n, size in dbs.items()}
+        self.merkers = (ctypes.c_uint8 * merkers)()
+        self.inputs = (ctypes.c_uint8 * inputs)()
+        self.outputs = (ctypes.c_uint8 * outputs)()
+        self.latency = latency
+        self._server = None
+        self._proxy = None
+        self._pending = []
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def area(self, name, db=0):
+        """Returns the area named D, M, I or Q, as in the driver's addresses.
+
+        @arg db number of the data block, for area D.
+        """
+        return {
+            "D": lambda: self.dbs[db],
+            "M": lambda: self.merkers,
+            "I": lambda: self.inputs,
+            "Q": lambda: self.outputs,
+        }[name.upper()]()
+
+    def load(self, name, address, data, db=0):
+        """Writes `data` to area `name` starting at byte `address`.
+
+        @arg name D, M, I or Q, as in the driver's addresses.
+        @arg address first byte to write.
+        @arg data a bytes-like object or an iterable of ints below 256.
+        @arg db number of the data block, for area D.
+        """
+        data = bytes(data)
+        area = self.area(name, db)
+        ctypes.memmove(ctypes.addressof(area) + address, data, len(data))
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Starts the server.
+
+        When `latency` is set, clients connect to a proxy that holds each
+        request for `latency` seconds before passing it to the server.
+
+        @arg host address to listen on.
+        @arg port port to listen on, 0 picks a free one.
+
+        @returns the (host, port) tuple the simulator is listening on.
+        """
+        server = snap7.server.Server(log=False)
+        areas = snap7.types
+        for number, db in self.dbs.items():
+            server.register_area(areas.srvAreaDB, number, db)
+        server.register_area(areas.srvAreaMK, 0, self.merkers)
+        server.register_area(areas.srvAreaPE, 0, self.inputs)
+        server.register_area(areas.srvAreaPA, 0, self.outputs)
+        self._server = server
+        if not self.latency:
+            port = port or _free_port(host)
+            server.start_to(host, port)
+            return (host, port)
+        target = _free_port("127.0.0.1")
+        server.start_to("127.0.0.1", target)
+        return self._serve_proxy(host, port, target)
+
+    def _serve_proxy(self, host, port, target):
+        proxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        proxy.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        proxy.bind((host, port))
+        proxy.listen()
+        self._proxy = proxy
+        thread = threading.Thread(target=self._accept, args=(target,), daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return proxy.getsockname()
+
+    def _accept(self, target):
+        while True:
+            try:
+                client, _ = self._proxy.accept()
+            except OSError:
+                return
+            server = socket.create_connection(("127.0.0.1", target))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for args in ((client, server, True), (server, client, False)):
+                threading.Thread(target=self._pump, args=args, daemon=True).start()
+
+    def _pump(self, source, sink, delay):
+        while True:
+            try:
+                data = source.recv(65536)
+                if not data:
+                    break
+                if delay and self.latency:
+                    time.sleep(self.latency)
+                sink.sendall(data)
+            except OSError:
+                break
+        for sock in (source, sink):
+            sock.close()
+
+    def inject_job_pending(self, client, size=None):
+        """Keeps `client` busy so its next requests fail with "Job pending".
+
+        Starts an asynchronous read of the Merker area on the client, a
+        `snap7.client.Client` connected to this simulator. Until it completes,
+        which takes at least `latency` seconds, snap7 refuses other requests
+        of that client with "Job pending", as it does with a busy PLC.
+
+        @arg size bytes to read, defaults to the whole Merker area.
+        """
+        size = len(self.merkers) if size is None else size
+        buffer = (ctypes.c_uint8 * size)()
+        # the client writes into buffer while the job runs
+        self._pending.append(buffer)
+        byte = snap7.types.WordLen.Byte
+        client.as_read_area(snap7.types.Areas.MK, 0, 0, size, byte, buffer)
+
+    def close(self):
+        """Stops serving and closes the proxy."""
+        if self._proxy:
+            self._proxy.close()
+            self._proxy = None
+        if self._server:
+            self._server.stop()
+            self._server.destroy()
+            self._server = None
+        for thread in self._threads:
+            thread.join(1)
+        self._threads = []
+        self._pending = []
+
+
+def _free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def benchmark(count=200, latency=0.0, repeat=3):
+    """Compares reading `count` words one by one, scattered in one multi
+    variable scan and contiguous in one block scan.
+
+    Scattered words are far enough apart that the driver can't merge them, so
+    they're packed in multi variable requests. Contiguous words are merged
+    into ranges read with the driver's cached scan plan.
+
+    @arg count amount of words to read.
+    @arg latency latency of the simulator for each request, in seconds.
+    @arg repeat how many times to run each measurement, the best is kept.
+
+    @returns a dictionary with the best time, in seconds, of each method.
+    """
+    import ahio
+
+    spacing = 32
+    with S7Simulator(dbs={1: count * spacing}, latency=latency) as simulator:
+        simulator.load("D", 0, bytes(range(256)) * (count * spacing // 256), db=1)
+        host, port = simulator.serve()
+        with ahio.new_driver("snap7") as plc:
+            plc.setup(host, 0, 1, port)
+            scattered = [("scattered", i) for i in range(count)]
+            contiguous = [("contiguous", i) for i in range(count)]
+            for i in range(count):
+                plc.map_pin(scattered[i], "DB1.DBW%d" % (i * spacing))
+                plc.map_pin(contiguous[i], "DB1.DBW%d" % (i * 2))
+            results = {}
+            for name, scan in (
+                ("single", lambda: [plc.read(pin) for pin in scattered]),
+                ("multi", lambda: plc.read(scattered)),
+                ("block", lambda: plc.read(contiguous)),
+            ):
+                results[name] = _best_time(scan, repeat)
+            for pin in scattered + contiguous:
+                plc.map_pin(pin, None)
+            return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    for name, seconds in benchmark(count, latency).items():
+        per_word = 1e6 * seconds / count
+        print("%-8s %8.2f ms  %8.1f us/word" % (name, 1e3 * seconds, per_word))
@@ -0,0 +1,304 @@
+# -*- coding: utf-8; -*-
+#
+# Copyright (c) 2016 Álan Crístoffer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""@package ahio.state_space
+Discrete linear state space models with NumPy.
+
+Functions here build and simulate the matrices of x[k+1] = A x[k] + B u[k],
+y[k] = C x[k] + D u[k], and are shared by the simulated drivers.
+
+Models can be given as Python expressions or loaded from `.npz` and `.json`
+files. Discretized models are cached in memory and in `cache_dir`, so setting
+up many drivers with the same model converts it only once.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+
+import numpy as np
+import scipy.linalg
+import scipy.signal
+
+# samples simulated by each product in trajectory()
+BLOCK = 256
+# most elements in the block matrix of trajectory()
+BLOCK_ELEMENTS = 2**20
+# names of the arrays of a model stored by name in a file
+MODEL_KEYS = ("A", "B", "C", "D", "dt")
+
+# directory of the on-disk cache, None disables it
+cache_dir = os.environ.get(
+    "AHIO_MODEL_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "ahio", "models"),
+)
+# files of the on-disk cache are named by the SHA-256 of the model
+_CACHE_ENTRY = re.compile(r"^[0-9a-f]{64}\.npz$")
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load(path):
+    """Loads a model from a `.npz` or `.json` file.
+
+    The file holds either the arrays A, B, C, D and optionally dt by name (an
+    object in JSON, keywords of `numpy.savez`), or the elements of a model
+    tuple in order (a list in JSON, positional arguments of `numpy.savez`).
+
+    @arg path path of the file.
+
+    @returns the model tuple, see `discretize`.
+
+    @throw ValueError if the file isn't a `.npz` or `.json` file.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npz":
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        if "A" not in arrays:
+            return tuple(arrays["arr_%d" % i] for i in range(len(arrays)))
+    elif extension == ".json":
+        with open(path) as f:
+            arrays = json.load(f)
+        if type(arrays) is list:
+            return tuple(arrays)
+    else:
+        raise ValueError("Unsupported model file: %s" % path)
+    return tuple(arrays[key] for key in MODEL_KEYS if key in arrays)
+
+
+def parse(model):
+    """Returns the model tuple described by `model`.
+
+    @arg model a model tuple, the path of a file accepted by `load` or a
+         string with a Python expression of the tuple.
+
+    @throw FileNotFoundError if `model` is the path of a missing file.
+    """
+    if type(model) is not str:
+        return model
+    if os.path.splitext(model)[1].lower() in (".npz", ".json"):
+        if not os.path.isfile(model):
+            raise FileNotFoundError("Model file not found: %s" % model)
+        return load(model)
+    return eval(model)
+
+
+def _key(model, dt):
+    digest = hashlib.sha256(repr(dt).encode())
+    for x in model:
+        x = np.ascontiguousarray(x)
+        digest.update(repr((x.dtype.str, x.shape)).encode())
+        digest.update(x.tobytes())
+    return digest.hexdigest()
+
+
+def _load_cached(key):
+    if cache_dir is None:
+        return None
+    try:
+        with np.load(os.path.join(cache_dir, key + ".npz")) as data:
+            return tuple(data[k] for k in "ABCD") + (float(data["dt"]),)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _store_cached(key, matrices):
+    if cache_dir is None:
+        return
+    A, B, C, D, dt = matrices
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written aside and renamed, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, A=A, B=B, C=C, D=D, dt=dt)
+        os.replace(tmp, os.path.join(cache_dir, key + ".npz"))
+    except OSError:
+        pass
+
+
+def clear_cache(disk=False):
+    """Forgets the discretized models.
+
+    @arg disk whether to also delete the files of the on-disk cache. Only
+         files named like cache entries are deleted, other files in
+         `cache_dir` are left alone.
+    """
+    with _cache_lock:
+        _cache.clear()
+    if disk and cache_dir is not None and os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if _CACHE_ENTRY.match(name):
+                os.remove(os.path.join(cache_dir, name))
+
+
+def discretize(model, dt=None):
+    """Returns the discrete state space matrices of `model`.
+
+    Results are cached by the contents of `model` and `dt`, first in memory
+    and then in `cache_dir`. The returned arrays are shared, so they are
+    read-only.
+
+    @arg model a tuple of arrays accepted by `scipy.signal.lti` (continuous
+         models) or, with the sample time as last element,
+         `scipy.signal.dlti` (discrete models).
+    @arg dt sample time of continuous models. By default it's based on the
+         fastest pole of the model.
+
+    @returns a tuple (A, B, C, D, dt) of float arrays and the sample time.
+    """
+    model = [np.array(x) for x in model]
+    key = _key(model, dt)
+    with _cache_lock:
+        matrices = _cache.get(key, None)
+    if matrices is None:
+        matrices = _load_cached(key)
+        if matrices is None:
+            matrices = _discretize(model, dt)
+            _store_cached(key, matrices)
+        for M in matrices[:4]:
+            M.flags.writeable = False
+        with _cache_lock:
+            _cache[key] = matrices
+    return matrices
+
+
+def _discretize(model, dt):
+
+    if len(model) % 2 == 1:
+        *model, dt = model
+        dt = float(dt)
+        G = scipy.signal.StateSpace(scipy.signal.dlti(*model, dt=dt))
+        model = G.A, G.B, G.C, G.D
+    else:
+        G = scipy.signal.StateSpace(scipy.signal.lti(*model))
+        model = G.A, G.B, G.C, G.D
+        if dt is None:
+            vals = scipy.linalg.eigvals(G.A)
+            dt = max(0.1, float("%.1f" % (max(abs(np.real(vals))) / 5)))
+        *model, _ = scipy.signal.cont2discrete(model, dt)
+
+    A, B, C, D = (np.ascontiguousarray(M, dtype=float) for M in model)
+    return A, B, C, D, dt
+
+
+def samples(elapsed, dt):
+    """Returns how many whole sample times `dt` fit in `elapsed` seconds."""
+    # the tolerance keeps rounding errors from losing a step
+    return int(elapsed / dt + 1e-9)
+
+
+def advance(A, B, x, u, steps, ax, bu):
+    """Advances the state `x` in place by `steps` samples, with `u` held.
+
+    The arrays can hold a stack of models, with the same leading dimensions
+    for all of them: A is ... x n x n, B ... x n x m, x ... x n x 1 and u
+    ... x m x 1. One step takes two products. Longer advances take
+    log(steps) products, whatever the number of steps.
+
+    @arg ax work array shaped like `x`.
+    @arg bu work array shaped like `x`.
+    """
+    if steps <= 0:
+        return
+    if steps == 1:
+        np.matmul(A, x, out=ax)
+        np.matmul(B, u, out=bu)
+        np.add(ax, bu, out=x)
+        return
+    # [x; 1] evolves by the powers of [[A, B u], [0, 1]] with the input held
+    n = A.shape[-1]
+    M = np.zeros(A.shape[:-2] + (n + 1, n + 1))
+    M[..., :n, :n] = A
+    np.matmul(B, u, out=M[..., :n, n:])
+    M[..., n, n] = 1
+    M = np.linalg.matrix_power(M, steps)
+    np.matmul(M[..., :n, :n], x, out=ax)
+    np.add(ax, M[..., :n, n:], out=x)
+
+
+def output(C, D, x, u, y, du):
+    """Computes y = C x + D u in place, see `advance` for the shapes.
+
+    @arg du work array shaped like `y`.
+    """
+    np.matmul(C, x, out=y)
+    np.matmul(D, u, out=du)
+    np.add(y, du, out=y)
+
+
+def trajectory(A, B, x0, u, block=BLOCK):
+    """Simulates x[k+1] = A x[k] + B u[k] for a whole input sequence.
+
+    Instead of one product per sample, the sequence is cut in blocks of
+    `block` samples. The response of every block to its inputs is computed
+    with a single product for all blocks, then the block starting states are
+    chained, one small product per block, and their free responses added in
+    another single product.
+
+    @arg A state matrix, n x n.
+    @arg B input matrix, n x m.
+    @arg x0 initial state, n elements.
+    @arg u inputs, an array of N x m (or N elements if m is 1).
+    @arg block samples per block, reduced for large models to keep the
+         block matrix below `BLOCK_ELEMENTS`.
+
+    @returns the states x[1] to x[N], an array of N x n.
+    """
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    n, m = B.shape
+    u = np.asarray(u, dtype=float).reshape(-1, m)
+    N = len(u)
+    if N == 0:
+        return np.zeros((0, n))
+    L = min(block, N, max(1, int((BLOCK_ELEMENTS / (n * m)) ** 0.5)))
+    blocks = -(-N // L)
+    padded = np.zeros((blocks * L, m))
+    padded[:N] = u
+
+    # powers[j] = A^j, for j = 0..L
+    powers = np.empty((L + 1, n, n))
+    powers[0] = np.eye(n)
+    for j in range(1, L + 1):
+        np.matmul(A, powers[j - 1], out=powers[j])
+    # toeplitz[j, :, i, :] = A^(j - i) B for i <= j, the effect of the input
+    # i of a block on its state j + 1
+    impulse = powers[:L] @ B
+    toeplitz = np.zeros((L, n, L, m))
+    for i in range(L):
+        toeplitz[i:, :, i, :] = impulse[: L - i]
+    toeplitz = toeplitz.reshape(L * n, L * m)
+    forced = (padded.reshape(blocks, L * m) @ toeplitz.T).reshape(blocks, L, n)
+
+    # state at the start of each block
+    starts = np.empty((blocks, n))
+    state = np.asarray(x0, dtype=float).reshape(n)
+    AL = powers[L]
+    for b in range(blocks):
+        starts[b] = state
+        state = AL @ state + forced[b, -1]
+    free = np.einsum("jkl,bl->bjk", powers[1:], starts)
+    return (forced + free).reshape(blocks * L, n)[:N]